@@ -5,6 +5,7 @@ import sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 import filter_func as ff
+import storage
 import multiprocessing
 from multiprocessing import Manager
 
@@ -35,11 +36,11 @@ def main():
         # Iterate through each file in the input folder
         params = []
         for file_name in os.listdir(input_folder1):
-            if file_name.endswith(".csv.gz"):
+            if file_name.endswith(storage.EXT):
                 input_file_path = os.path.join(input_folder1, file_name)
                 params.append([input_file_path, output_folder1])
         for file_name in os.listdir(input_folder2):
-            if file_name.endswith(".csv.gz"):
+            if file_name.endswith(storage.EXT):
                 input_file_path = os.path.join(input_folder2, file_name)
                 params.append([input_file_path, output_folder2])
         L = len(params)
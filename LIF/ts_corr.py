@@ -2,9 +2,12 @@
 
 import os
 import sys
-import gzip
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
 import numpy as np
+import storage
 import multiprocessing
+from scipy.sparse import csr_matrix
 from multiprocessing import Manager
 np.random.seed(1234)
 
@@ -19,6 +22,21 @@ def standardize_matrix(matrix):
     
     return standardized_matrix
 
+def spike_corr(S):
+    """
+    Pearson correlation matrix of binary spike trains stored as a CSR matrix of shape (n, T)
+    whose row j holds the sample indices of the spikes of neuron j.
+
+    """
+    S = csr_matrix((np.ones_like(S.data), S.indices, S.indptr), shape=S.shape)
+    T = S.shape[1]
+    rate = np.asarray(S.sum(axis=1)).ravel()/T
+    cov = (S @ S.T).toarray()/T - np.outer(rate, rate)
+    std = np.sqrt(np.diag(cov))
+    correlation_matrix = cov/np.outer(std, std)
+
+    return np.clip(correlation_matrix, -1, 1)
+
 def ts_corr(params, counter, lock, L):
     with lock:  # Use explicit lock for thread safety
         counter.value += 1
@@ -27,15 +45,22 @@ def ts_corr(params, counter, lock, L):
      # Extract input/output folder paths
     input_, output_ = params
 
-    with gzip.open(input_, "rt") as f:
-        x_vals_loaded = np.loadtxt(f, delimiter=",")
+    if input_.endswith(".npz"):
+        # Spike trains are correlated directly in their sparse format
+        S, meta = storage.load_spikes(input_)
+        correlation_matrix = spike_corr(S)
+        meta.update(n=S.shape[0], T=S.shape[1])
+    else:
+        x_vals_loaded = storage.load_array(input_)
+        meta = storage.load_header(input_)
+        for key in ("shape", "dtype", "compression"):
+            meta.pop(key)
 
-    standized_vals = standardize_matrix(x_vals_loaded)
-    correlation_matrix = np.corrcoef(standized_vals, rowvar=False)
+        standized_vals = standardize_matrix(x_vals_loaded)
+        correlation_matrix = np.corrcoef(standized_vals, rowvar=False)
 
     # Save the results
-    with gzip.open(output_, "wt") as f:
-            np.savetxt(f, correlation_matrix, delimiter=",")
+    storage.save_triu(output_, correlation_matrix, **meta)
 
 def main():
 
@@ -54,14 +79,14 @@ def main():
         # Iterate through each file in the input folder
         params = []
         for file_name in os.listdir(input_folder1):
-            if file_name.endswith(".csv.gz"):
+            if file_name.endswith(storage.EXT):
                 input_file_path = os.path.join(input_folder1, file_name)
                 output_file_path = os.path.join(output_folder1, file_name)
                 params.append([input_file_path, output_file_path])
         for file_name in os.listdir(input_folder2):
-            if file_name.endswith(".csv.gz"):
+            if file_name.endswith(".npz"):
                 input_file_path = os.path.join(input_folder2, file_name)
-                output_file_path = os.path.join(output_folder2, file_name)
+                output_file_path = os.path.join(output_folder2, file_name[:-len(".npz")] + storage.EXT)
                 params.append([input_file_path, output_file_path])
         L = len(params)
 
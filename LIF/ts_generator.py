@@ -5,43 +5,398 @@ import os
 import sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-import gzip
+import math
+import array
+import heapq
 import numpy as np
 import networkx as nx
 import runge_kutta as rk
+import storage
 import multiprocessing
 from multiprocessing import Manager
-from scipy.sparse import csr_matrix, save_npz
+from functools import lru_cache
+from scipy.sparse import csc_matrix, csr_matrix
+from scipy.special import hyperu
 
-np.random.seed(1234)
+SEED = 1234
+np.random.seed(SEED)
 
 # Define state variables for the neurons
 class LIFState:
-    def __init__(self, n):
-        self.fire = np.zeros(n)
-        self.t_f = np.zeros(n)
+    def __init__(self, shape):
+        # 'shape' is either the number of neurons n or (batch, n) for a stacked ensemble
+        # Presynaptic conductance traces k*exp(-(t - t_f)/tau_syn), valid at time 't'
+        self.s = np.zeros(shape)
+        self.t = 0.
 
-# Define the LIF function
-def LIF(u, t, k, A, state,
+        # Workspaces reused by every call of LIF
+        self.spikes = np.zeros(shape, dtype=bool)
+        self.work = np.zeros(shape)
+
+# Define the LIF function (the derivative is written into 'out' if given).
+# A is expected in CSR format.
+def LIF(u, t, k, A, state, out=None,
         u_rest=0, u_r=-5, theta=60, 
         R=50, tau=10, I=10, u_syn=65, tau_syn=5):
-    
-    state.fire[u > theta] = k
-    state.t_f[u > theta] = t
-    u[u > theta] = u_r
-    g = state.fire*np.exp(-(t - state.t_f) / tau_syn)
-    g = np.dot(A,g)
-    
-    return (u_rest - u + R*I)/tau - g*(u - u_syn)
 
-# Define function to convert the time series to spike trains
-def spike_train(ts):
+    # The traces decay multiplicatively once per step and are set to k only for the neurons
+    # that just fired
+    if t != state.t:
+        state.s *= np.exp(-(t - state.t)/tau_syn)
+        state.t = t
+    spikes = np.greater(u, theta, out=state.spikes)
+    if spikes.any():
+        state.s[spikes] = np.broadcast_to(k, u.shape)[spikes]
+        u[spikes] = u_r
+
+    # g = A.s through the sparse adjacency
+    g = A.dot(state.s.T).T
+    work = state.work
+
+    # out = (u_rest - u + R*I)/tau - g*(u - u_syn)
+    if out is None:
+        out = np.empty_like(u)
+    np.subtract(u_rest, u, out=out)
+    out += R*I
+    out /= tau
+    np.subtract(u, u_syn, out=work)
+    work *= g
+    out -= work
+
+    return out
+
+# Exact sub-threshold propagation used by the event-driven engine. It relies on the scaled upper
+# incomplete gamma function S(z) = exp(z)*z**(-a)*Gamma(a, z) for the single value a = -tau_syn/tau,
+# which is tabulated once (see _gamma_table) so that it costs a few multiplications per evaluation.
+GAMMA_SPLIT = 2.                    # S is evaluated from its power series below, from the table above
+GAMMA_SERIES = 30                   # terms of the power series
+GAMMA_PANELS, GAMMA_DEGREE = 64, 6  # panels of the table and degree of their polynomials
+LAGUERRE_X, LAGUERRE_W = np.polynomial.laguerre.laggauss(64)
+
+@lru_cache(maxsize=None)
+def _gamma_table(a):
+    """
+    Coefficients of S(z) = exp(z)*z**(-a)*Gamma(a, z), for a < 0, accurate to about 1e-14:
+    - for z < GAMMA_SPLIT, S(z) = exp(z)*(Gamma(a)*z**(-a) - sum_m (-z)**m/(m!*(m + a))), whose power
+      series is truncated to GAMMA_SERIES terms. This form does not exist for an integer a, for which
+      the series is None and Tricomi's function U is used instead;
+    - for z >= GAMMA_SPLIT, z*S(z) = int_0^inf (1 + x/z)**(a-1) exp(-x) dx is a smooth function of
+      y = GAMMA_SPLIT/z in (0, 1]. It is interpolated (from Gauss-Laguerre quadrature) on GAMMA_PANELS
+      equal panels of y by polynomials of degree GAMMA_DEGREE in the local variable
+      x = 2*(y*GAMMA_PANELS - p) - 1 of the panel p.
+    The coefficients are stored from the highest degree, both as arrays and as lists (for scalars).
+    """
+    if a == round(a):
+        gamma_a, series = np.nan, None
+    else:
+        gamma_a = math.gamma(a)
+        series = np.array([(-1)**m/(math.factorial(m)*(m + a)) for m in range(GAMMA_SERIES)])[::-1]
+
+    nodes = np.cos(np.pi*(np.arange(GAMMA_DEGREE + 1) + 0.5)/(GAMMA_DEGREE + 1))
+    panels = np.empty((GAMMA_PANELS, GAMMA_DEGREE + 1))
+    for p in range(GAMMA_PANELS):
+        z = GAMMA_SPLIT*GAMMA_PANELS/(p + (nodes + 1)/2)
+        zS = np.dot((1 + LAGUERRE_X/z[:, np.newaxis])**(a - 1), LAGUERRE_W)
+        panels[p] = np.polynomial.polynomial.polyfit(nodes, zS, GAMMA_DEGREE)[::-1]
+
+    return gamma_a, series, panels, None if series is None else series.tolist(), panels.tolist()
+
+def scaled_upper_gamma(a, z):
+    """
+    Scaled upper incomplete gamma function exp(z)*z**(-a)*Gamma(a, z), for a < 0 and an array z >= 0
+    (see _gamma_table).
+    """
+    gamma_a, series, panels, _, _ = _gamma_table(a)
+    z = np.asarray(z, dtype=float)
+    out = np.empty_like(z)
+
+    small = z < GAMMA_SPLIT
+    if small.any():
+        zs = z[small]
+        if series is None:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                out[small] = np.where(zs > 0, zs**-a*hyperu(1 - a, 1 - a, zs), -1/a)
+        else:
+            f = np.zeros_like(zs)
+            for c in series:
+                f *= zs
+                f += c
+            out[small] = np.exp(zs)*(gamma_a*zs**-a - f)
+    if not small.all():
+        zl = z[~small]
+        y = GAMMA_SPLIT*GAMMA_PANELS/zl
+        p = np.minimum(y.astype(int), GAMMA_PANELS - 1)
+        x = 2*(y - p) - 1
+        coef = panels[p]
+        q = np.zeros_like(zl)
+        for d in range(GAMMA_DEGREE + 1):
+            q *= x
+            q += coef[:, d]
+        out[~small] = q/zl
+
+    return out
+
+def scalar_gamma(a):
+    """
+    scaled_upper_gamma(a, z) as a function of a single z (python float), without the overhead of numpy.
+    """
+    gamma_a, _, _, series, panels = _gamma_table(a)
+    exp = math.exp
+
+    def gamma(z):
+        if z < GAMMA_SPLIT:
+            if series is None:
+                return float(z**-a*hyperu(1 - a, 1 - a, z)) if z > 0 else -1/a
+            f = 0.
+            for c in series:
+                f = f*z + c
+            return exp(z)*(gamma_a*z**-a - f)
+        y = GAMMA_SPLIT*GAMMA_PANELS/z
+        p = min(int(y), GAMMA_PANELS - 1)
+        x = 2*(y - p) - 1
+        q = 0.
+        for c in panels[p]:
+            q = q*x + c
+        return q/z
+
+    return gamma
+
+def LIF_propagate(u, g, s, G0=None, u_rest=0, R=50, tau=10, I=10, u_syn=65, tau_syn=5):
+    """
+    Exact solution after a time s of the sub-threshold LIF dynamics
+        du/dt = (u_rest - u + R*I)/tau - g(t)*(u - u_syn),   g(t) = g*exp(-t/tau_syn),
+    obtained with the integrating factor Phi(s) = exp(s/tau + g*tau_syn*(1 - exp(-s/tau_syn))),
+    whose integral is expressed through incomplete gamma functions. u, g and s are arrays.
+    G0 = scaled_upper_gamma(-tau_syn/tau, g*tau_syn) is computed if not given.
+
+    Returns:
+    - u, g: Membrane potential and conductance after the time s.
+    - G: scaled_upper_gamma of the final conductance, i.e. the G0 of the next propagation.
+    """
+    a = -tau_syn/tau
+    z0 = g*tau_syn
+    decay = np.exp(-s/tau_syn)
+    z1 = z0*decay
+    phi = np.exp(z1 - z0 - s/tau)  # 1/Phi(s)
+    if G0 is None:
+        G0 = scaled_upper_gamma(a, z0)
+    G1 = scaled_upper_gamma(a, z1)
+
+    # integral_0^s Phi(r) dr / Phi(s) = tau_syn*(G1 - phi*G0) (tau*(1 - exp(-s/tau)) for g = 0)
+    u = u*phi + u_syn*(1 - phi) + ((u_rest + R*I) - u_syn)/tau*tau_syn*(G1 - phi*G0)
+
+    return u, g*decay, G1
+
+def crossing_time(f, s, lo, hi, tol=1e-10):
+    """
+    Root in [lo, hi] of an increasing function, by Newton iteration from s safeguarded by
+    bisection. f(s) returns the value of the function and its derivative.
+    """
+    for _ in range(100):
+        f_s, df = f(s)
+        if abs(f_s) < tol or hi - lo < tol:
+            break
+        if f_s < 0:
+            lo = s
+        else:
+            hi = s
+
+        # Newton step, replaced by bisection whenever it leaves the bracket
+        s_new = s - f_s/df if df > 0 else lo
+        s = s_new if lo < s_new < hi else 0.5*(lo + hi)
+
+    return s
+
+def LIF_events(u0, T, k, A, dt=0.01, record_every=1, burn_in=0,
+               u_rest=0, u_r=-5, theta=60,
+               R=50, tau=10, I=10, u_syn=65, tau_syn=5):
+    """
+    Event-driven simulation of the LIF network.
+    Between spikes the potential and the synaptic conductances are propagated exactly (see
+    LIF_propagate). The next threshold crossing of every neuron is kept in a single priority queue,
+    and a spike only updates, and reschedules, the neuron that fired and its postsynaptic
+    neighbours, so the cost of the spikes is O(spikes x fan-out x log n). A rescheduled neuron
+    first enters the queue with a lower bound of its crossing time (the potential is concave in
+    time, so its tangent reaches the threshold first), and the exact crossing is only solved for
+    when this bound comes up.
+    The work of a spike only involves a few neurons, so it is done one neuron at a time on python
+    floats, where numpy would mostly cost call overhead. The potentials of all the neurons at the
+    sampling times are read with a single LIF_propagate, which only fills in their pending G.
+    As in LIF, the conductance of neuron i is sum_j A_ij k exp(-(t - t_j)/tau_syn), with t_j the
+    last spike time of neuron j.
+    The engine assumes excitatory, supra-threshold dynamics (u_rest + R*I > theta, u_syn > theta
+    and k >= 0), for which the sub-threshold potential is always increasing and reaches the
+    threshold no later than without synaptic input.
+
+    Parameters:
+    - u0: Initial membrane potentials.
+    - T, dt, record_every, burn_in: Sampling grid of the potential (see runge_kutta).
+    - k: Coupling strength.
+    - A: Adjacency matrix (dense or sparse).
 
-    train = np.zeros(len(ts))
-    for i in range(len(ts) - 2):
-        if ts[i-1] < ts[i] and ts[i] > ts[i+1]:
-            train[i] = 1
-    return train
+    Returns:
+    - t_values: Array of the sampled time points.
+    - u_values: Membrane potentials at the sampled time points.
+    - spike_times: Exact spike times, in increasing order.
+    - spike_neurons: Index of the neuron emitting each spike.
+    """
+    u_inf = u_rest + R*I
+    if u_inf <= theta or u_syn <= theta or k < 0:
+        raise ValueError("LIF_events requires supra-threshold drive and excitatory coupling.")
+    params = dict(u_rest=u_rest, R=R, tau=tau, I=I, u_syn=u_syn, tau_syn=tau_syn)
+    a = -tau_syn/tau
+    gamma = scalar_gamma(a)
+    exp, log, heappush, heappop = math.exp, math.log, heapq.heappush, heapq.heappop
+
+    A = csc_matrix(A, dtype=float)  # column j holds the postsynaptic neighbours of j
+    post = [A.indices[A.indptr[j]:A.indptr[j + 1]].tolist() for j in range(A.shape[1])]
+    weights = [A.data[A.indptr[j]:A.indptr[j + 1]].tolist() for j in range(A.shape[1])]
+    t_values, idx = rk.sampling_grid(T, dt, record_every, burn_in)
+    t_values = t_values[idx]
+
+    # State of the neurons, valid at the time t_last. G holds the scaled gamma of g*tau_syn (the G0
+    # of LIF_propagate), or nan until it is needed after a synaptic input. The arrays of floats are
+    # cheap to index one neuron at a time and are read by numpy without copies at the sampling times
+    n = len(u0)
+    u = array.array('d', np.asarray(u0, dtype=float))
+    g = array.array('d', bytes(8*n))
+    G = array.array('d', [gamma(0.)])*n
+    t_last = array.array('d', bytes(8*n))
+    u_n, g_n, G_n, t_last_n = (np.frombuffer(x) for x in (u, g, G, t_last))
+    fire = [0.]*n       # presynaptic traces fire*exp(-(t - t_f)/tau_syn)
+    t_f = [0.]*n
+    version = [0]*n     # invalidates outdated entries of the queue
+    u_values = np.zeros((len(t_values), n))
+    spike_times, spike_neurons = [], []
+    queue = []
+
+    def potential(u_j, g_j, G_j, s):
+        # LIF_propagate of a single neuron
+        z0 = g_j*tau_syn
+        decay = exp(-s/tau_syn)
+        z1 = z0*decay
+        phi = exp(z1 - z0 - s/tau)
+        G1 = gamma(z1)
+        return u_j*phi + u_syn*(1 - phi) + (u_inf - u_syn)/tau*tau_syn*(G1 - phi*G_j), g_j*decay, G1
+
+    def advance(j, t):
+        if G[j] != G[j]:
+            G[j] = gamma(g[j]*tau_syn)
+        u[j], g[j], G[j] = potential(u[j], g[j], G[j], t - t_last[j])
+        t_last[j] = t
+
+    def schedule(j):
+        # Push a lower bound of the next threshold crossing of j (tangent at t_last)
+        version[j] += 1
+        du = (u_inf - u[j])/tau + g[j]*(u_syn - u[j])
+        heappush(queue, (t_last[j] + max(theta - u[j], 0.)/du, version[j], j, False))
+
+    def solve(j):
+        # Exact crossing of neuron j, bracketed by the crossing without synaptic input. The
+        # Newton iteration starts from the tangent, or from the bracket without conductance
+        u_j, g_j = u[j], g[j]
+        if u_j >= theta:
+            return t_last[j]
+        if G[j] != G[j]:
+            G[j] = gamma(g_j*tau_syn)
+        G_j = G[j]
+
+        def f(s):
+            u_s, g_s, _ = potential(u_j, g_j, G_j, s)
+            return u_s - theta, (u_inf - u_s)/tau + g_s*(u_syn - u_s)
+
+        s_max = tau*log(max((u_inf - u_j)/(u_inf - theta), 1))
+        s = (theta - u_j)/((u_inf - u_j)/tau + g_j*(u_syn - u_j)) if g_j > 0 else s_max
+        return t_last[j] + crossing_time(f, min(s, s_max), 0., s_max)
+
+    for j in range(n):
+        schedule(j)
+    for m, t_next in enumerate(t_values):
+        while queue and queue[0][0] <= t_next:
+            t_s, ver, j, exact = heappop(queue)
+            if ver != version[j]:
+                continue
+            if not exact:
+                heappush(queue, (solve(j), ver, j, True))
+                continue
+
+            # Reset of j, whose conductance keeps decaying
+            advance(j, t_s)
+            u[j] = u_r
+            schedule(j)
+            spike_times.append(t_s)
+            spike_neurons.append(j)
+
+            # Update of the postsynaptic conductances (nothing to do without coupling)
+            kick = k - fire[j]*exp(-(t_s - t_f[j])/tau_syn)
+            fire[j], t_f[j] = k, t_s
+            if kick:
+                for p, w in zip(post[j], weights[j]):
+                    advance(p, t_s)
+                    g[p] += w*kick
+                    G[p] = np.nan
+                    schedule(p)
+
+        stale = np.isnan(G_n)
+        if stale.any():
+            G_n[stale] = scaled_upper_gamma(a, g_n[stale]*tau_syn)
+        u_values[m] = LIF_propagate(u_n, g_n, t_next - t_last_n, G_n, **params)[0]
+
+    return t_values, u_values, np.array(spike_times), np.array(spike_neurons, dtype=int)
+
+# Define spike detection on the membrane potential.
+# Spikes are stored as a CSR matrix of shape (n, T): row j holds the sample indices of the
+# spikes of neuron j and, as data, the corresponding spike times.
+def spike_matrix(neurons, rows, times, shape):
+    """
+    CSR spike matrix of the spikes (neurons[e], rows[e]) at times[e]. Only the first spike of a
+    neuron within a sample is kept, so that duplicate entries are never summed.
+    """
+    order = np.lexsort((times, rows, neurons))
+    neurons, rows, times = neurons[order], rows[order], times[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (neurons[1:] != neurons[:-1]) | (rows[1:] != rows[:-1])
+
+    return csr_matrix((times[first], (neurons[first], rows[first])), shape=shape)
+
+class SpikeDetector:
+    """
+    Vectorised spike detection on a membrane potential fed in consecutive blocks of shape
+    (len(t_block), n). A spike is a strict local maximum of the time series.
+    """
+    def __init__(self):
+        self.t_tail, self.x_tail = None, None   # last two samples of the previous block
+        self.n_samples = 0
+        self.neurons, self.rows, self.times = [], [], []
+
+    def update(self, t_block, x_block):
+        if self.x_tail is None:
+            t, x = t_block, x_block
+        else:
+            t, x = np.concatenate((self.t_tail, t_block)), np.concatenate((self.x_tail, x_block))
+        start = self.n_samples + len(x_block) - len(x)  # sample index of x[0]
+
+        rows, neurons = np.nonzero((x[1:-1] > x[:-2]) & (x[1:-1] > x[2:]))
+        self.neurons.append(neurons)
+        self.rows.append(start + 1 + rows)
+        self.times.append(t[1 + rows])
+
+        self.t_tail, self.x_tail = t[-2:], x[-2:]
+        self.n_samples += len(x_block)
+
+    def spikes(self):
+        n = self.x_tail.shape[1]
+        return spike_matrix(np.concatenate(self.neurons), np.concatenate(self.rows), np.concatenate(self.times),
+                            (n, self.n_samples))
+
+def spike_train(t_vals, x_vals):
+    """
+    Spike trains of the membrane potentials x_vals of shape (len(t_vals), n), in the CSR
+    format described above.
+    """
+    detector = SpikeDetector()
+    detector.update(t_vals, x_vals)
+    return detector.spikes()
 
 def ts_generator(params, counter, lock, L):
     with lock:  # Use explicit lock for thread safety
@@ -52,32 +407,63 @@ def ts_generator(params, counter, lock, L):
     input_, output1_, output2_, n, i = params
 
     G = nx.read_gml(input_)
-    A = nx.adjacency_matrix(G).toarray()
+    A = csr_matrix(nx.adjacency_matrix(G), dtype=float)
 
     # Initial conditions and equation parameters
     T, dt = 10, 0.005
+    burn_in, record_every = 0, 1    # transient time discarded and decimation of the stored steps
     u0 = -20 + np.random.rand(n)*40
     K_c = 0.4    # rescaling factor
     K = [0.0, K_c, 1.5*K_c, 2.5*K_c, 5*K_c] # LIF coupling regimes
 
-    # Run the Runge-Kutta for different coupling regimes
+    engine = os.getenv("LIF_ENGINE", "rk4")  # 'rk4' or 'events' (event-driven with exact spike times)
+    block_size = 200    # number of time steps held in memory by the streaming integrator
+
+    # Header of the stored membrane potentials: number of samples, sampling interval and run parameters
+    dt_int = 0.01   # step actually used by both engines (their default, 'dt' above is not passed)
+    n_samples = len(rk.sampling_grid(T, dt_int, record_every, burn_in)[1])
+    shape_paths, spike_paths, metas = [], [], []
     for k in K:
-        state = LIFState(n)
         out_folder1 = os.path.join(output1_, "K_{}".format(np.round(k/K_c,1)))
         out_folder2 = os.path.join(output2_, "K_{}".format(np.round(k/K_c,1)))
         os.makedirs(out_folder1, exist_ok=True)
         os.makedirs(out_folder2, exist_ok=True)
-        t_vals, x_vals = rk.runge_kutta(LIF, u0, T, A=A, k=k, state=state)
-        spike_trains = np.array([spike_train(ts) for ts in x_vals.T])
+        shape_paths.append(os.path.join(out_folder1, "LIF_{}_{}{}".format(n, i, storage.EXT)))
+        metas.append(dict(model="LIF", n=n, i=i, K=np.round(k/K_c,1), T=n_samples, dt=dt_int*record_every, seed=SEED))
+        spike_paths.append(os.path.join(out_folder2, "LIF_{}_{}.npz".format(n, i)))
+
+    if engine == "events":
+        for k, shape_path, spike_path, meta in zip(K, shape_paths, spike_paths, metas):
+            t_vals, x_vals, spike_times, spike_neurons = LIF_events(u0, T, k, A, record_every=record_every,
+                                                                   burn_in=burn_in)
+            # Save the results. Each spike is assigned to the last sample before the reset
+            # and keeps its exact time as data (only the first one if a neuron fires twice
+            # between two samples).
+            storage.save_array(shape_path, x_vals, **meta)
+
+            rows = np.searchsorted(t_vals, spike_times, side='right') - 1
+            keep = rows >= 0
+            storage.save_spikes(spike_path, spike_matrix(spike_neurons[keep], rows[keep], spike_times[keep], (n, len(t_vals))),
+                                **meta)
+    else:
+        # Run a single Runge-Kutta for all the coupling regimes stacked in one ensemble, stream the
+        # membrane potentials to disk and detect the spikes while integrating
+        u0_batch = np.tile(u0, (len(K), 1))
+        k_batch = np.reshape(K, (-1, 1))
+        state = LIFState(u0_batch.shape)
+        detectors = [SpikeDetector() for _ in K]
 
-        # Save the results
-        file_path_out = os.path.join(out_folder1, "LIF_{}_{}.csv.gz".format(n, i))
-        with gzip.open(file_path_out, "wt") as f:
-            np.savetxt(f, x_vals, delimiter=",")
+        def blocks():
+            for t_block, x_block in rk.runge_kutta_blocks(LIF, u0_batch, T, block_size=block_size, inplace=True,
+                                                          record_every=record_every, burn_in=burn_in,
+                                                          A=A, k=k_batch, state=state):
+                for j, detector in enumerate(detectors):
+                    detector.update(t_block, x_block[:, j, :])
+                yield t_block, x_block
 
-        file_path_out = os.path.join(out_folder2, "LIF_{}_{}.csv.gz".format(n, i))
-        with gzip.open(file_path_out, "wt") as f:
-            np.savetxt(f, spike_trains.T, delimiter=",")
+        storage.write_blocks(blocks(), shape_paths, meta=metas)
+        for detector, spike_path, meta in zip(detectors, spike_paths, metas):
+            storage.save_spikes(spike_path, detector.spikes(), **meta)
 
 def main():
     input_folder = "./graphs"
@@ -2,9 +2,11 @@
 # (1) Naive; (2) RMT + Naive; (3) Fisher; (4) RMT + Fisher
 
 import os
-import gzip
 import numpy as np
-from scipy.sparse import csr_matrix, save_npz
+import storage
+from scipy.linalg import eigh
+from scipy.sparse import csr_matrix
+from scipy.sparse.linalg import eigsh
 
 def getPCA(matrix):
     """
@@ -22,84 +24,201 @@ def getPCA(matrix):
     eVal, eVec = eVal[indices], eVec[:, indices]
     return eVal, eVec
 
-def apply_thresh(input_file, output_path):
-    p_list = [.1, .15, .2, .25] # filter parameter for naive filtering
-    tau_list = [1., 1.5, 2., 2.5]
-    T = 2000
-    
+def signal_eigs(matrix, eMax, solver = "range", max_frac = .05):
+    """
+    Gets the eigenpairs of a Hermitian matrix whose eigenvalue is above a given bound
+    Args:
+        matrix np.ndarray: Correlation matrix
+        eMax float: Lower bound of the eigenvalues
+        solver str: 'full' (complete eigh), 'range' (LAPACK driver computing only the eigenvalues
+                    in [eMax, inf)) or 'lanczos' (eigsh on the largest eigenvalues, doubling their
+                    number until one below eMax is found)
+        max_frac float: With 'lanczos', fraction of the spectrum above which the signal subspace
+                        is considered large and a full eigh is used instead
+    Returns:
+         (tuple): tuple containing:
+            np.ndarray: Eigenvalues above eMax
+            np.ndarray: Corresponding eigenvectors
+    """
+    n = len(matrix)
+    if solver == "full":
+        eVal, eVec = getPCA(matrix)
+    elif solver == "range":
+        eVal, eVec = eigh(matrix, subset_by_value=[eMax, np.inf], driver="evr")
+    elif solver == "lanczos":
+        k = 8
+        while k <= max_frac*n:
+            eVal, eVec = eigsh(matrix, k=k, which='LA', v0=np.ones(n))
+            if eVal.min() < eMax:
+                break
+            k *= 2
+        else:
+            eVal, eVec = getPCA(matrix)
+    else:
+        raise ValueError(f"Unknown eigensolver '{solver}'")
+
+    signal = eVal >= eMax
+    return eVal[signal], eVec[:, signal]
+
+def rmt_filter(matrix, q, solver = "range", block_size = 256):
+    """
+    Removes the noise from a correlation matrix keeping only the eigenmodes above the upper
+    edge of the Marchenko-Pastur distribution. The cleaned matrix V_s diag(eVal_s) V_s^T, built
+    from the signal eigenpairs, is computed directly in packed form, 'block_size' rows at a
+    time, so that no dense n x n copy is made
+    Args:
+        matrix np.ndarray: Correlation matrix
+        q float: Ratio T/n between the length of the time series and their number
+        solver str: Eigensolver used for the signal eigenpairs (see signal_eigs)
+        block_size int: Number of rows of the cleaned matrix computed at once
+    Returns:
+         (tuple): tuple containing:
+            np.ndarray: Packed strict upper triangle of the cleaned matrix
+            np.ndarray: Diagonal of the cleaned matrix
+    """
+    n = len(matrix)
+    eMax = (1 + (1./q)**.5)**2
+    eVal_s, V_s = signal_eigs(matrix, eMax, solver)
+    W_s = V_s*eVal_s
+
+    packed = np.empty(n*(n - 1)//2)
+    for i0 in range(0, n, block_size):
+        i1 = min(i0 + block_size, n)
+        block = W_s[i0:i1] @ V_s[i0:].T  # rows i0:i1, columns i0:n
+        start, stop = i0*(2*n - i0 - 1)//2, i1*(2*n - i1 - 1)//2
+        packed[start:stop] = block[np.triu_indices(i1 - i0, 1, n - i0)]
+    return packed, np.einsum('ij,ij->i', W_s, V_s)
+
+def naive_cuts(packed, diag, p_list):
+    """
+    Naive filter: for every p, keeps the entries of a symmetric matrix whose value is among the
+    lowest p fraction of its distinct values. The packed upper triangle and the diagonal are
+    sorted once, so that every p selects a prefix of the same ordering
+    Args:
+        packed np.ndarray: Packed strict upper triangle of the matrix
+        diag np.ndarray: Diagonal of the matrix
+        p_list list: Fractions of the distinct values kept
+    Returns:
+         (tuple): tuple containing:
+            np.ndarray: Ordering of the entries, indices >= len(packed) being diagonal entries
+            list: Length of the prefix of the ordering selected by each p
+    """
+    values = np.concatenate([packed, diag])
+    order = np.argsort(values, kind='stable')
+    sorted_vals = values[order]
+    first = np.flatnonzero(np.r_[True, sorted_vals[1:] != sorted_vals[:-1]])  # first entry of each distinct value
+    first = np.append(first, len(values))
+    return order, [first[int(p*(len(first) - 1))] for p in p_list]
+
+METHODS = ["Fisher", "FisherRMT", "Naive", "NaiveRMT"]
+TAU_LIST = [1., 1.5, 2., 2.5]   # Fisher thresholds (in units of the standard error of the z-transform)
+P_LIST = [.1, .15, .2, .25]     # filter parameter for naive filtering
+
+def sweep_edges(packed, order, cuts):
+    """
+    Sorted edge array of one filtering method
+    Args:
+        packed np.ndarray: Packed strict upper triangle of the matrix
+        order np.ndarray: Entries of the packed triangle in the order they enter the network
+        cuts list: Number of entries of 'order' kept by each threshold
+    Returns:
+        dict: rows, cols and weights of the edges order[:max(cuts)] (zero weights excluded, as
+              in a sparse matrix) and the cuts as prefix lengths of these arrays
+    """
+    rows, cols = storage.triu_indices(storage.triu_n(len(packed)))
+    cuts = np.asarray(cuts, dtype=np.int64)
+    top = order[:cuts.max(initial=0)]
+    nonzero = packed[top] != 0
+    top = top[nonzero]
+    return {"rows": rows[top].astype(np.int32), "cols": cols[top].astype(np.int32),
+            "weights": packed[top], "cuts": np.r_[0, np.cumsum(nonzero)][cuts]}
+
+def fisher_sweep(packed, T, tau_list):
+    """
+    Fisher filter: for every tau, keeps the entries above the correlation whose Fisher
+    z-transform is tau standard errors 1/sqrt(T - 3) away from zero. The edges are sorted by
+    decreasing weight, so that every tau selects a prefix
+    """
+    z = 2*np.asarray(tau_list)/np.sqrt(T - 3)
+    C_tau = (np.exp(z) - 1)/(np.exp(z) + 1)
+    candidates = np.flatnonzero(packed >= C_tau.min(initial=np.inf))
+    order = candidates[np.argsort(-packed[candidates], kind='stable')]
+    cuts = [np.count_nonzero(packed[candidates] >= c) for c in C_tau]
+    return sweep_edges(packed, order, cuts)
+
+def naive_sweep(packed, diag, p_list):
+    """
+    Naive filter on the sorted edges (see naive_cuts). Diagonal entries count among the
+    distinct values but are not edges
+    """
+    order, cuts = naive_cuts(packed, diag, p_list)
+    triangle = order < len(packed)
+    return sweep_edges(packed, order[triangle], np.r_[0, np.cumsum(triangle)][cuts])
+
+def save_sweep(file_path, n, sweep, thresholds):
+    """
+    Saves the sorted edge arrays of all the methods in a single .npz file
+    """
+    arrays = {"n": n}
+    for method, edges in sweep.items():
+        arrays.update({f"{method}_{key}": val for key, val in edges.items()})
+        arrays[f"{method}_thresholds"] = np.asarray(thresholds[method], dtype=float)
+    np.savez(file_path, **arrays)
+
+def load_sweep(file_path):
+    """
+    Loads a sweep file written by apply_thresh
+    Returns:
+         (tuple): tuple containing:
+            int: Number of nodes
+            dict: for every method, dict of rows, cols, weights, cuts and thresholds
+    """
+    with np.load(file_path) as f:
+        n = int(f["n"])
+        sweep = {m: {key: f[f"{m}_{key}"] for key in ["rows", "cols", "weights", "cuts", "thresholds"]}
+                 for m in METHODS if f"{m}_cuts" in f}
+    return n, sweep
+
+def threshold_edges(edges, j):
+    """
+    Edges (rows, cols, weights) of the network of the j-th threshold of a method
+    """
+    cut = edges["cuts"][j]
+    return edges["rows"][:cut], edges["cols"][:cut], edges["weights"][:cut]
+
+def threshold_matrix(n, edges, j):
+    """
+    Sparse symmetric weighted adjacency matrix of the j-th threshold of a method
+    """
+    rows, cols, weights = threshold_edges(edges, j)
+    return csr_matrix((np.r_[weights, weights], (np.r_[rows, cols], np.r_[cols, rows])), shape=(n, n))
+
+def apply_thresh(input_file, output_path, tau_list = TAU_LIST, p_list = P_LIST):
+    """
+    Filters a correlation matrix with the four methods and saves, in a single sweep file
+    'output_path/{base_name}.npz', the edges of each method sorted in the order they enter the
+    network together with the prefix length selected by each threshold
+    """
     # Extract n and i from the file name
-    base_name = os.path.splitext(input_file)[0][:-4]  # remove .csv.gz extension
+    base_name = os.path.splitext(input_file)[0]  # remove .bin extension
     base_name = base_name.split("/")[-1]
     _, n_str, _ = base_name.split('_')
     n = int(n_str)
-    
+
+    # Length of the time series the matrix was estimated from, recorded in the header
+    T = storage.load_header(input_file).get("T", 2000)
     q = T/n
-    with gzip.open(input_file, "rt") as f:
-        C = np.loadtxt(f, delimiter=",")
-
-    #---FISHER THRESHOLDING WITH AND WITHOUT RMT FILTERING---
-    for tau in tau_list:
-        
-        eVal, eVec = getPCA(C)
-        eMax = (1 + (1./q)**.5)**2
-        C_Fish = np.copy(C)
-        C_RMT = np.copy(C)
-        for i,eig in enumerate(eVal):
-            if eig < eMax:
-                v = np.reshape(eVec[:,i],(-1,1))
-                C_RMT -= eig*np.dot(v,v.T)
-        C_tau = (np.exp(2*tau/np.sqrt(T - 3)) - 1)/(np.exp(2*tau/np.sqrt(T - 3)) + 1)
-
-        C_RMT[C_RMT < C_tau] = 0    # RMT filtering + Fisher
-        C_Fish[C_Fish < C_tau] = 0  # Fisher filtering
-
-        # save results
-        output_path1 = os.path.join(output_path,"FisherRMT") #specify thresholding method
-        os.makedirs(output_path1, exist_ok=True)
-        output_path2 = os.path.join(output_path1,f"tau{tau}") #specify threshold
-        os.makedirs(output_path2, exist_ok=True)
-        file_path_out = os.path.join(output_path2,base_name)
-        save_npz(file_path_out, csr_matrix(C_RMT))
-
-        output_path1 = os.path.join(output_path,"Fisher") #specify thresholding method
-        os.makedirs(output_path1, exist_ok=True)
-        output_path2 = os.path.join(output_path1,f"tau{tau}") #specify threshold
-        os.makedirs(output_path2, exist_ok=True)
-        file_path_out = os.path.join(output_path2,base_name)
-        save_npz(file_path_out, csr_matrix(C_Fish))
-
-    #---NAIVE THRESHOLDING OF CORRELATION MATRIX with RMT filtering---
-    for p in p_list:
-        
-        eVal, eVec = getPCA(C)
-        eMax = (1 + (1./q)**.5)**2
-        C_RMT = np.copy(C)
-        for i,eig in enumerate(eVal):
-            if eig < eMax:
-                v = np.reshape(eVec[:,i],(-1,1))
-                C_RMT -= eig*np.dot(v,v.T)
-                
-        # RMT filtering + Naive
-        C_RMT_flat = np.unique(C_RMT.flatten())
-        vals = C_RMT_flat[:int(p*len(C_RMT_flat))]
-        C_RMT_naive = np.where(np.isin(C_RMT, vals), C_RMT, 0)
-
-        # Naive filtering
-        C_flat = np.unique(C.flatten())
-        vals = C_flat[:int(p*len(C_flat))]
-        C_naive = np.where(np.isin(C, vals), C, 0) 
-        
-        # save results
-        output_path1 = os.path.join(output_path,"NaiveRMT") #specify thresholding method
-        os.makedirs(output_path1, exist_ok=True)
-        output_path2 = os.path.join(output_path1,f"p{p}") #specify threshold
-        os.makedirs(output_path2, exist_ok=True)
-        file_path_out = os.path.join(output_path2,base_name)
-        save_npz(file_path_out, csr_matrix(C_RMT_naive))
-        
-        output_path1 = os.path.join(output_path,"Naive") #specify thresholding method
-        os.makedirs(output_path1, exist_ok=True)
-        output_path2 = os.path.join(output_path1,f"p{p}") #specify threshold
-        os.makedirs(output_path2, exist_ok=True)
-        file_path_out = os.path.join(output_path2,base_name)
-        save_npz(file_path_out, csr_matrix(C_naive))
\ No newline at end of file
+    C_packed = np.asarray(storage.load_triu(input_file))
+
+    # The dense matrix is only needed by the eigensolver. The spectrum is computed only once per matrix
+    solver = os.getenv("RMT_SOLVER", "range")  # 'range', 'lanczos' or 'full' (see signal_eigs)
+    C_RMT_packed, C_RMT_diag = rmt_filter(storage.unpack_triu(C_packed), q, solver)
+
+    sweep = {"Fisher": fisher_sweep(C_packed, T, tau_list),
+             "FisherRMT": fisher_sweep(C_RMT_packed, T, tau_list),
+             "Naive": naive_sweep(C_packed, np.ones(n), p_list),
+             "NaiveRMT": naive_sweep(C_RMT_packed, C_RMT_diag, p_list)}
+    thresholds = {"Fisher": tau_list, "FisherRMT": tau_list, "Naive": p_list, "NaiveRMT": p_list}
+
+    os.makedirs(output_path, exist_ok=True)
+    save_sweep(os.path.join(output_path, base_name), n, sweep, thresholds)
@@ -1,119 +1,53 @@
 # Module which contains many functions for computing global measures
 
-import os
+import time
 import numpy as np
+import networkx as nx
 import graph_tool.all as gt
-from scipy.sparse import load_npz
+from concurrent.futures import ThreadPoolExecutor
 from scipy.stats import linregress
 
-def build_dict():
-    N_dict = {}
-    for k in [0.0, 1.0, 1.5, 2.5, 5.0]:
-        N_dict[f"K_{k}"] = {}
-        for N in [100, 200, 500, 1000]:
-            N_dict[f"K_{k}"][f"N_{N}"] = {}
-            for i in range(1,26):
-                N_dict[f"K_{k}"][f"N_{N}"][i] = {}
-                N_dict[f"K_{k}"][f"N_{N}"][i]["Fisher"] = {}
-                N_dict[f"K_{k}"][f"N_{N}"][i]["FisherRMT"] = {}
-                N_dict[f"K_{k}"][f"N_{N}"][i]["Naive"] = {}
-                N_dict[f"K_{k}"][f"N_{N}"][i]["NaiveRMT"] = {}
-                for tau in ["tau1.0", "tau1.5", "tau2.0", "tau2.5"]:
-                    N_dict[f"K_{k}"][f"N_{N}"][i]["Fisher"][tau] = {}
-                    N_dict[f"K_{k}"][f"N_{N}"][i]["FisherRMT"][tau] = {}
-                for p in ["p0.1", "p0.15", "p0.2", "p0.25"]:
-                    N_dict[f"K_{k}"][f"N_{N}"][i]["Naive"][p] = {}
-                    N_dict[f"K_{k}"][f"N_{N}"][i]["NaiveRMT"][p] = {}
-    N_dict["original"] = {}
-    for N in [100, 200, 500, 1000]:
-        N_dict["original"][f"N_{N}"] = {}
-        for i in range(1, 26):
-            N_dict["original"][f"N_{N}"][i] = {}
-
-    return N_dict
-
-def extract_file_information(file_path):
-    base_name = os.path.splitext(file_path)[0]
-    split_base_name = base_name.split('/')
-    name = split_base_name[-1]
-    _, n_str, i_str = name.split('_')
-    thresh = split_base_name[-2]
-    method = split_base_name[-3]
-    
-    return(i_str, n_str, method, thresh)
-
-def explore_dict(global_dict, keys):
-    # Function to easily access global variables.
-    # 'keys' is an array of strings containing ORDERED keys from bottom to top.
-    # Example: keys = ['Neigh_degree','N_100'] is ok but the opposite is not.
-    n_nodes = list(global_dict.keys())
-    idx = list(global_dict['N_100'].keys())
-    methods = list(global_dict['N_100'][1].keys())
-    taus = list(global_dict['N_100'][1]['Fisher'].keys())
-    ps = list(global_dict['N_100'][1]['Naive'].keys())
-    measures = list(global_dict['N_100'][1]['Fisher']['tau1.0'].keys())
-
-    out_dict = global_dict
-    for key in keys:
-        if key in measures:
-            out_dict = {n:  {i: {m: {t: out_dict[n][i][m][t][key] for t in taus} for m in ['Fisher','FisherRMT']} | {m: {p: out_dict[n][i][m][p][key] for p in ps} for m in ['Naive','NaiveRMT']} for i in idx} for n in n_nodes}
-        elif key in ps:
-            out_dict = {n:  {i: {m: out_dict[n][i][m][key] for m in ['Naive','NaiveRMT']} for i in idx} for n in n_nodes}
-        elif key in taus:
-            out_dict = {n:  {i: {m: out_dict[n][i][m][key] for m in ['Fisher','FisherRMT']} for i in idx} for n in n_nodes}
-        elif key in methods:
-            out_dict = {n:  {i: out_dict[n][i][key] for i in idx} for n in n_nodes}
-        elif key in idx:
-            out_dict = {n: out_dict[n][key] for n in n_nodes}
-        elif key in n_nodes:
-            out_dict = out_dict[key]
-        else:
-            return 'Wrong key input.'
-    return out_dict
-
-def mat2edgelist(csv_matrix):
-    # function to convert a matrix saved in csv format into an edge list
-    A = load_npz(csv_matrix).toarray()
-    for i in range(len(A)):
-        A[i,i] = 0
-    edge_list = []
-    for source in range(len(A)):
-        for target in np.nonzero(A[source,:])[0]:
-            edge_list.append((source,target))
-    return edge_list
+def edges2graph(n, rows, cols, weights=None):
+    # function to build an undirected graph with n vertices (isolated ones included) from the
+    # upper-triangular edges (rows, cols) of a filtered network, each edge being stored once.
+    # The weights, if given, are attached as the edge property map g.ep["weight"]
+    g = gt.Graph(directed=False)
+    g.add_vertex(n)
+    if weights is None:
+        g.add_edge_list(np.column_stack([rows, cols]))
+    else:
+        w = g.new_edge_property("double")
+        g.add_edge_list(np.column_stack([rows, cols, weights]), eprops=[w])
+        g.ep["weight"] = w
+    return g
+
+def neighbor_degrees(A, degrees):
+    # knn of every vertex from the sparse adjacency and the degree sequence (0 for isolated vertices)
+    knn = A @ degrees.astype(float)  # sparse, so that knn is a single sparse matvec
+    np.divide(knn, degrees, out=knn, where=degrees != 0)
+    return knn
 
 def average_neighbor_degree(g):
     nodes = g.get_vertices()
-    degrees = np.reshape(g.get_out_degrees(nodes),(-1,1))
-    A = gt.adjacency(g).todense()
-    knn = np.dot(A,degrees)
-    for i in range(len(degrees)):
-        if degrees[i] != 0:
-            knn[i] /= degrees[i]
-    knn = np.asarray(knn).reshape(-1)
-    return {n: k for n, k in zip(nodes,knn)}
+    knn = neighbor_degrees(gt.adjacency(g), g.get_out_degrees(nodes))
+    return dict(zip(nodes, knn))
 
-def knn_scaling_exponent(g):
+def knn_exponent(degree_list, knns_vals):
+    # Exponent of the scaling knn(k) ~ k^alpha from the degree and knn of every vertex
 
-    nodes = g.get_vertices()
-    degree_list = g.get_out_degrees(nodes)
-    knns = average_neighbor_degree(g)
-    knns_vals = np.array(list(knns.values()))
-
-    avg_knns = []
-    for k in range(1,int(np.max(degree_list) + 1)):
-        N = len(nodes[degree_list == k])
-        arr = knns_vals[degree_list == k]
-        if N == 0: avg_knns.append(0)
-        else: avg_knns.append(np.sum(arr)/N)
-    avg_knns = np.array(avg_knns)
+    # Average knn of the nodes of each degree k = 1, ..., k_max (0 if there is none).
+    # graph_tool returns uint64 degrees, which np.bincount refuses under numpy < 2
+    degree_list = np.asarray(degree_list).astype(np.int64)
+    k_max = int(np.max(degree_list))
+    counts = np.bincount(degree_list, minlength=k_max + 1)[1:]
+    sums = np.bincount(degree_list, weights=knns_vals, minlength=k_max + 1)[1:]
+    avg_knns = np.zeros(k_max)
+    np.divide(sums, counts, out=avg_knns, where=counts != 0)
     
     # Log-transform the data
-    y = avg_knns[avg_knns > 0]
-    x = np.array([i for i in range(1,int(np.max(degree_list) + 1))])
-    x = x[avg_knns > 0]
-    x = np.log(x)
-    y = np.log(y)
+    observed = avg_knns > 0
+    x = np.log(np.arange(1, k_max + 1)[observed])
+    y = np.log(avg_knns[observed])
     if len(y) <= 1: return (0,0)
     
     # Perform linear regression to fit log(knn) = alpha * log(k) + C
@@ -121,55 +55,252 @@ def knn_scaling_exponent(g):
     
     return (slope, std_err)
 
-def avg_shortest_path(g):
-    nodes = g.get_vertices()
-    n = len(nodes)
-    distances = np.array(gt.shortest_distance(g))
-    if np.any(distances >= n): return np.nan
-    return np.sum(distances)/(n*(n - 1))
-        
+def knn_scaling_exponent(g, knns=None):
+    # 'knns' is the output of average_neighbor_degree(g), computed if not given
+    if knns is None:
+        knns = average_neighbor_degree(g)
+    return knn_exponent(g.get_out_degrees(g.get_vertices()), np.array(list(knns.values())))
+
+def distance_sums(g, sources, n_threads=1):
+    # Sum of the BFS distances from each source (-1 if some vertex is unreachable from it).
+    # Only one distance vector per thread is alive at a time, never the full distance matrix
+    n = g.num_vertices()
+    def bfs(v):
+        d = gt.shortest_distance(g, source=g.vertex(v)).a
+        return d.sum(dtype=np.int64) if np.all(d < n) else -1
+    if n_threads > 1:
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            return np.array(list(pool.map(bfs, sources)), dtype=np.int64)
+    return np.array([bfs(v) for v in sources], dtype=np.int64)
+
+def avg_shortest_path(g, n_threads=1):
+    # Exact average over all the ordered pairs, with one BFS per source. NaN if the graph is disconnected
+    n = g.num_vertices()
+    if n < 2: return np.nan
+    sum0 = distance_sums(g, [0])[0]
+    if sum0 < 0: return np.nan  # a single BFS tells if the graph is connected
+    sums = distance_sums(g, range(1, n), n_threads)
+    return (sum0 + np.sum(sums))/(n*(n - 1))
+
+def sampled_shortest_path(g, n_pivots, seed=None, n_threads=1):
+    # Estimate of the average shortest path from the BFS of 'n_pivots' random sources.
+    # Returns (estimate, standard error), the error including the finite population correction.
+    # (NaN, NaN) if the graph is disconnected
+    n = g.num_vertices()
+    if n < 2 or distance_sums(g, [0])[0] < 0: return (np.nan, np.nan)
+    k = min(n_pivots, n)
+    pivots = np.random.default_rng(seed).choice(n, size=k, replace=False)
+    l = distance_sums(g, pivots, n_threads)/(n - 1)  # average distance from each pivot
+    if k == n or k < 2: return (np.mean(l), 0.)
+    std_err = np.std(l, ddof=1)/np.sqrt(k)*np.sqrt(1 - k/n)
+    return (np.mean(l), std_err)
+
+def communities(g, backend="sbm", init=None, max_sweeps=1000, tol=1e-8):
+    # Partition of the vertices of g in communities, computed with the selected backend:
+    #   'sbm': minimum description length of the stochastic block model. If 'init' (block of each
+    #          vertex, e.g. the partition found for the neighbouring threshold of the same matrix)
+    #          is given, it is refined by zero-temperature merge-split sweeps until the description
+    #          length stops decreasing, instead of being optimised from scratch
+    #   'louvain': greedy multi-level modularity optimisation
+    #   'label_propagation': semi-synchronous label propagation
+    # Returns the block of each vertex and a dictionary with the runtime, whether the optimisation
+    # converged and the number of sweeps (or Louvain levels) it took
+    start = time.perf_counter()
+    n_iter, converged = np.nan, True
+    if backend == "sbm":
+        if init is None:
+            state = gt.minimize_blockmodel_dl(g)
+        else:
+            state = gt.BlockState(g, b=g.new_vp("int", vals=init))
+            converged = False
+            for n_iter in range(1, max_sweeps + 1):
+                dS, _, _ = state.multiflip_mcmc_sweep(beta=np.inf, niter=10)
+                if abs(dS) < tol:
+                    converged = True
+                    break
+        blocks = np.array(state.get_blocks().a)
+    elif backend in ("louvain", "label_propagation"):
+        G = nx.Graph()
+        G.add_nodes_from(range(g.num_vertices()))
+        G.add_edges_from(g.get_edges().tolist())
+        if backend == "louvain":
+            levels = list(nx.community.louvain_partitions(G, seed=0))
+            parts, n_iter = levels[-1], len(levels)
+        else:
+            parts = nx.community.label_propagation_communities(G)
+        blocks = np.empty(g.num_vertices(), dtype=int)
+        for c, part in enumerate(parts):
+            blocks[list(part)] = c
+    else:
+        raise ValueError(f"Unknown community backend '{backend}'")
+
+    return blocks, {'runtime': time.perf_counter() - start, 'converged': converged, 'n_iter': n_iter}
+
+# Registry of the global measures. Every measure declares the intermediates it needs (degree
+# sequence, adjacency, knn, ...), which are computed lazily and cached once per graph by
+# GraphContext, so that only what the requested measures need is ever evaluated.
+# DEFAULT_MEASURES are the ones computed when no list is given; the others must be requested.
+INTERMEDIATES = {}
+MEASURES = {}
+DEFAULT_MEASURES = []
+
+def intermediate(name):
+    # Decorator registering the function f(ctx) computing an intermediate quantity of a graph
+    def register(f):
+        INTERMEDIATES[name] = f
+        return f
+    return register
+
+def measure(name, inputs, default=True):
+    # Decorator registering a measure computed as f(*inputs) from the listed intermediates.
+    # f returns the dictionary of the values to store
+    for i in inputs:
+        if i not in INTERMEDIATES:
+            raise ValueError(f"Measure '{name}' depends on the unknown intermediate '{i}'")
+    def register(f):
+        MEASURES[name] = (f, tuple(inputs))
+        if default:
+            DEFAULT_MEASURES.append(name)
+        return f
+    return register
+
+class GraphContext:
+    # Lazily computed intermediates of a graph, cached for the lifetime of the context.
+    # 'options' are the run options read by the intermediates (n_pivots, seed, n_threads, community, warm_start)
+    def __init__(self, g, **options):
+        self.g = g
+        self.options = options
+        self.cache = {}
+
+    def __getitem__(self, name):
+        if name not in self.cache:
+            self.cache[name] = INTERMEDIATES[name](self)
+        return self.cache[name]
+
+@intermediate('graph')
+def _graph(ctx):
+    return ctx.g
 
-def compute_global_variables(obj, load=False):
+@intermediate('degrees')
+def _degrees(ctx):
+    return ctx.g.get_out_degrees(ctx.g.get_vertices())
+
+@intermediate('adjacency')
+def _adjacency(ctx):
+    return gt.adjacency(ctx.g)
+
+@intermediate('knn')
+def _knn(ctx):
+    return neighbor_degrees(ctx['adjacency'], ctx['degrees'])
+
+@intermediate('communities')
+def _communities(ctx):
+    # Partition of the community backend (see communities). 'warm_start' is a dict shared along a
+    # threshold sweep of one matrix: the partition found is stored in it and, with the 'sbm'
+    # backend, the next graph starts from it
+    community = ctx.options.get('community', "sbm")
+    warm_start = ctx.options.get('warm_start')
+    init = warm_start.get('blocks') if warm_start is not None and community == "sbm" else None
+    blocks, info = communities(ctx.g, community, init)
+    if warm_start is not None:
+        warm_start['blocks'] = blocks
+    return blocks, info
+
+@intermediate('path_length')
+def _path_length(ctx):
+    # Exact average shortest path or, with the option 'n_pivots', its sampled estimate and error,
+    # the pivots being drawn with the option 'seed'. The BFS are spread over 'n_threads' threads
+    n_pivots = ctx.options.get('n_pivots')
+    n_threads = ctx.options.get('n_threads', 1)
+    if n_pivots:
+        return sampled_shortest_path(ctx.g, n_pivots, seed=ctx.options.get('seed'), n_threads=n_threads)
+    return avg_shortest_path(ctx.g, n_threads), None
+
+@measure('Mean_degree', ['degrees'])
+def _mean_degree(degrees):
+    return {'Mean_degree': np.mean(degrees)}
+
+@measure('MR_coefficient', ['degrees'])
+def _mr_coefficient(degrees):
+    # Molloy-Reed coefficient
+    return {'MR_coefficient': np.mean(np.array(degrees)**2)/np.mean(degrees)}
+
+@measure('Neigh_degree', ['knn'])
+def _neigh_degree(knn):
+    return {'Neigh_degree': np.mean(knn)}
+
+@measure('Mixing_exponent', ['degrees', 'knn'])
+def _mixing_exponent(degrees, knn):
+    return {'Mixing_exponent': knn_exponent(degrees, knn)}
+
+@measure('Global_clustering', ['graph'])
+def _global_clustering(g):
+    return {'Global_clustering': gt.global_clustering(g)}
+
+@measure('Assortativity', ['graph'])
+def _assortativity(g):
+    return {'Assortativity': gt.assortativity(g, "total")}
+
+@measure('Modularity', ['graph', 'communities'])
+def _modularity(g, partition):
+    # Modularity of the community partition (minimum description length by default)
+    blocks, info = partition
+    return {'Modularity': gt.modularity(g, g.new_vp("int", vals=blocks)),
+            'Modularity_runtime': info['runtime'],
+            'Modularity_converged': info['converged'],
+            'Modularity_iterations': info['n_iter']}
+
+@measure('Components', ['graph'], default=False)
+def _components(g):
+    # Number of connected components and size of the largest one
+    _, hist = gt.label_components(g)
+    return {'N_components': len(hist), 'Giant_component': np.max(hist, initial=0)}
+
+@measure('Avg_path_length', ['path_length'])
+def _avg_path_length(path_length):
+    L, err = path_length
+    return {'Avg_path_length': L} if err is None else {'Avg_path_length': L, 'Avg_path_length_err': err}
+
+def compute_global_variables(obj, load=False, measures=None, **options):
+    # 'obj' is either an undirected gt.Graph (see edges2graph) or, with load=True, a gml file.
+    # 'measures' lists the names of the measures to compute (see MEASURES). Default is DEFAULT_MEASURES.
+    # 'options' are passed to the intermediates:
+    #   n_pivots: the average path length is estimated from that number of BFS sources
+    #   seed: seed of the random BFS sources
+    #   n_threads: number of threads running the BFS of the average path length
+    #   community: backend of the modularity (see communities)
+    #   warm_start: dict carrying the partition along a threshold sweep (see _communities)
 
     if not load:
-        g = gt.Graph()
-        g.add_edge_list(obj)
+        g = obj
     else:
         g = gt.load_graph(obj, fmt='gml')
 
+    if measures is None:
+        measures = list(DEFAULT_MEASURES)
+    unknown = [m for m in measures if m not in MEASURES]
+    if unknown:
+        raise ValueError(f"Unknown measures {unknown}, available: {list(MEASURES)}")
+
+    ctx = GraphContext(g, **options)
     glob_dict = {}
+    for name in measures:
+        f, inputs = MEASURES[name]
+        glob_dict.update(f(*[ctx[i] for i in inputs]))
     
-    #Mean degree
-    degree_sequence = g.get_out_degrees(g.get_vertices())
-    glob_dict['Mean_degree'] = np.mean(degree_sequence)
-    
-    #Molloy-Reed coefficient
-    seq2 = np.array(degree_sequence)**2
-    glob_dict['MR_coefficient'] = np.mean(seq2)/np.mean(degree_sequence)
-    
-    #Avg. neigh. degree
-    n_deg = average_neighbor_degree(g)
-    glob_dict['Neigh_degree'] = np.mean(list(n_deg.values()))
+    return glob_dict
 
-    #Mixing exponent
-    expo = knn_scaling_exponent(g)
-    glob_dict['Mixing_exponent'] = expo
-    
-    #Global clustering
-    clust = gt.global_clustering(g)
-    glob_dict['Global_clustering'] = clust
-
-    #Assortativity
-    assort = gt.assortativity(g, "in")
-    glob_dict['Assortativity'] = assort
-
-    #Modularity via minimum description length
-    mdl_state = gt.minimize_blockmodel_dl(g)
-    b = mdl_state.get_blocks()
-    mod = gt.modularity(g, b)
-    glob_dict['Modularity'] = mod
-
-    #Avg. path length
-    glob_dict['Avg_path_length'] = avg_shortest_path(g)
-    
-    return glob_dict
\ No newline at end of file
+def result_rows(glob_dict):
+    # Flattens the output of compute_global_variables into (measure, value, error) rows of the
+    # results table (see storage.ResultsWriter). Measures given as (value, error) and the
+    # '<measure>_err' entries fill the error column, which is nan otherwise.
+    rows = []
+    for name, value in glob_dict.items():
+        if name.endswith('_err') and name[:-len('_err')] in glob_dict:
+            continue
+        if isinstance(value, tuple):
+            value, err = value
+        else:
+            err = glob_dict.get(name + '_err', np.nan)
+        rows.append((name, float(value), float(err)))
+    return rows
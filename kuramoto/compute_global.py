@@ -6,45 +6,67 @@ import os
 import sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
+import argparse
 import numpy as np
 from global_funcs import *
+import storage
+import filter_func as ff
+import sweep_funcs as sf
 import multiprocessing
-from multiprocessing import Manager
-
-def compute_global(params, counter, lock, L):
-    with lock:  # Use explicit lock for thread safety
-        counter.value += 1
-        print(f"Computing... {counter.value}/{L}", end="\r")
-    
-        input_, output_, k, K_dict = params
-
-        # Since python is not good at manage parallelized objects it is necessary to un-nest nested dictionaries (don't really know why but it works)
-        if k == "original":
-            base_name = os.path.splitext(input_)[0]
-            split_base_name = base_name.split('/')
-            name = split_base_name[-1]
-            _, N, idx = name.split('_')
-            nested_dict = K_dict[k]
-            nested_dict[f"N_{N}"][int(idx)] = compute_global_variables(input_, load=True)
-            K_dict[k] = nested_dict
-        else:
-            idx, N, method, thresh = extract_file_information(input_)
-            edge_list = mat2edgelist(input_)
-            nested_dict = K_dict[f"K_{k}"]
-            nested_dict2 = nested_dict[f"N_{N}"]
-            nested_dict3 = nested_dict2[int(idx)]
-            nested_dict3[method][thresh] = compute_global_variables(edge_list)
-            nested_dict2[int(idx)] = nested_dict3
-            nested_dict[f"N_{N}"] = nested_dict2
-            K_dict[f"K_{k}"] = nested_dict
+
+SEED = 1234  # seed of the pivots of the sampled path length
+
+def compute_global(params):
+    # Workers only return the rows of their results, which are written by the main process (no shared state)
+    input_, output_, k, measures = params
+    n_pivots = int(os.getenv("PATH_PIVOTS", 0)) or None  # BFS sources of the sampled path length. Default is exact
+    n_threads = int(os.getenv("N_THREADS", 1))  # threads running the BFS of the path length, within each process
+    community = os.getenv("COMMUNITY", "sbm")  # 'sbm', 'louvain' or 'label_propagation'
+    warm = os.getenv("WARM_START", "0") == "1"  # start the sbm from the partition of the previous threshold
+    incremental = os.getenv("INCREMENTAL", "0") == "1"  # update the measures along the threshold sweep when possible
+
+    # Rows (K, N, replica, method, threshold, measure, value, error) of the results table
+    base_name = os.path.splitext(input_)[0]
+    _, N, idx = base_name.split('/')[-1].split('_')
+    if k == "original":
+        glob_dict = compute_global_variables(input_, load=True, measures=measures, n_pivots=n_pivots,
+                                             seed=SEED, n_threads=n_threads, community=community)
+        return [(np.nan, int(N), int(idx), "original", np.nan) + row for row in result_rows(glob_dict)]
+
+    # One sweep file per matrix holds the networks of all the methods and thresholds
+    n, sweep = ff.load_sweep(input_)
+    graph_measures = [m for m in measures if not (incremental and m in sf.INCREMENTAL_MEASURES)]
+    rows = []
+    for method, edges in sweep.items():
+        warm_start = {} if warm else None
+        if incremental:
+            sweep_dicts = sf.sweep_measures(n, edges, [m for m in measures if m in sf.INCREMENTAL_MEASURES])
+        for j, thresh in enumerate(edges["thresholds"]):
+            glob_dict = sweep_dicts[j] if incremental else {}
+            if graph_measures:
+                g = edges2graph(n, *ff.threshold_edges(edges, j))
+                glob_dict.update(compute_global_variables(g, measures=graph_measures, n_pivots=n_pivots, seed=SEED,
+                                                          n_threads=n_threads, community=community, warm_start=warm_start))
+            rows += [(k, int(N), int(idx), method, thresh) + row for row in result_rows(glob_dict)]
+
+    return rows
 
 def main():
+    parser = argparse.ArgumentParser(description="Compute the global measures of the filtered networks.")
+    parser.add_argument("--measures", type=str, nargs="+", default=list(DEFAULT_MEASURES), choices=list(MEASURES),
+                        help="Measures to compute. Default is all of them but Components")
+    args = parser.parse_args()
+
     output_folder = "/mnt/global_measures"
     os.makedirs(output_folder, exist_ok=True)
 
     num_cores = int(os.getenv("NUM_CORES", 8))  # Number of cores used. Default is 8
 
+    # Results table, one row per (model, K, N, replica, method, threshold, measure) (see storage.load_results)
+    writer = storage.ResultsWriter(os.path.join(output_folder, 'kuramoto'), mode="w")
+
     ### RECONSTRUCTED NETWORKS ###
+    model = "kuramoto"
     for k in [0.0, 1.0, 1.5, 2.5, 5.0, "original"]:
         print(f"Computing global measures for k={k}")
         if k != "original":
@@ -58,39 +80,17 @@ def main():
             for file_name in files:
                 if file_name.endswith(".npz") or file_name.endswith(".gml"):
                     input_file_path = os.path.join(root, file_name)
-                    params.append([input_file_path, output_folder, k])
+                    params.append([input_file_path, output_folder, k, args.measures])
 
         L = len(params)
 
-        # Create a shared variables using Manager
-        with Manager() as manager:
-            K_dict = manager.dict(build_dict())  # Shared dictionary
-            counter = manager.Value('i', 0)  # Shared counter
-            lock = manager.Lock()  # Shared lock
-
-            # Parallel processing
-            with multiprocessing.Pool(processes=num_cores) as pool:
-                pool.starmap(compute_global, [(param + [K_dict], counter, lock, L) for param in params])
-            standard_dict = dict(K_dict)
-
-        # Save the dictionary
-        file_path = os.path.join(output_folder, f'K_{k}.npy')
-        np.save(file_path, standard_dict)
-
-    print('Saving files...')
-    # Collect all the results in a single dictionary and save it
-    total_dict = build_dict()
-    for k in ["K_0.0", "K_1.0", "K_1.5", "K_2.5", "K_5.0"]:
-        temp = np.load(f"/mnt/global_measures/{k}.npy", allow_pickle=True).item()
-        total_dict[k] = temp[k]
-        # os.remove(f"/mnt/global_measures/{k}.npy")
-
-    temp = np.load("/mnt/global_measures/K_original.npy", allow_pickle=True).item()
-    total_dict['original'] = temp['original']
-    # os.remove("/mnt/global_measures/K_original.npy")
-
-    file_path = os.path.join(output_folder, 'kuramoto.npy')
-    np.save(file_path, total_dict)
+        # Parallel processing, the rows are written as soon as they are ready
+        with multiprocessing.Pool(processes=num_cores) as pool:
+            for c, rows in enumerate(pool.imap_unordered(compute_global, params)):
+                print(f"Computing... {c + 1}/{L}", end="\r")
+                writer.append([(model,) + row for row in rows])
+
+    writer.close()
 
     sys.stdout.write("\r" + " " * 50 + "\r")  # Clear the line by overwriting with spaces
     print('\tDone!')
@@ -3,8 +3,10 @@
 
 import os
 import sys
-import gzip
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
 import numpy as np
+import storage
 import pandas as pd
 from scipy.interpolate import interp1d
 from sklearn.neighbors import KernelDensity
@@ -83,8 +85,7 @@ def eig_distribution(file_list,input_folder):
     pdf_array = np.zeros(int((zf - zi)/0.01))
 
     for file in file_list:
-        with gzip.open(os.path.join(input_folder,file), "rt") as f:
-                x = np.loadtxt(f, delimiter=",")
+        x = storage.load_matrix(os.path.join(input_folder,file))
         eVal, eVec = getPCA(x)
         pdf = fitKDE(eVal, bWidth=0.01)
         pdf_func = interp1d(pdf.index, pdf.values, kind='cubic', fill_value=0, bounds_error=False)
@@ -108,7 +109,7 @@ def main():
         print("\tExtracting files...", end="\r")
         for file_name in os.listdir(input_folder):
             # Extract n and i from the file name
-            base_name = os.path.splitext(file_name)[0][:-4]  # remove .csv.gz extension
+            base_name = os.path.splitext(file_name)[0]  # remove .bin extension
             _, n_str, i_str = base_name.split('_')
             n = int(n_str)
             i = int(i_str)
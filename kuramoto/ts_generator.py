@@ -5,23 +5,66 @@ import os
 import sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-import gzip
 import numpy as np
 import networkx as nx
 import runge_kutta as rk
+import storage
 import multiprocessing
 from multiprocessing import Manager
-
-np.random.seed(1234)
-
-# Define the kuramoto function (normalized with respect to the mean degree)
-def kuramoto(x, t, w, k, A):
-    
-    phase_diff = x[:, np.newaxis] - x
-    sin_phase_diff = np.sin(phase_diff)
-    coupling_term = k/np.mean(np.sum(A, axis=1))*np.dot(A, sin_phase_diff)
-    
-    return w + np.diag(coupling_term)
+from scipy.sparse import csr_matrix
+
+SEED = 1234
+np.random.seed(SEED)
+
+# Define the kuramoto coupling operator (normalized with respect to the mean degree)
+class KuramotoCoupling:
+    """
+    Right-hand side of the Kuramoto model on a fixed graph.
+
+    The coupling sum_j A_ij sin(x_j - x_i) is expanded as
+    cos(x_i) (A sin x)_i - sin(x_i) (A cos x)_i, so that every call costs a single
+    sparse product instead of building the n x n matrix of phase differences.
+    The sparse adjacency and the mean-degree normalization are computed once per graph,
+    hence the same operator can be reused for every coupling regime.
+    The state x can also be a stacked ensemble of shape (batch, n), in which case w and k
+    broadcast against it (e.g. k of shape (batch, 1) gives one coupling per member).
+    If 'out' is given the derivative is written into it, and sin/cos are evaluated in a
+    workspace kept between calls, so the only allocation left is the sparse product.
+
+    Parameters:
+    - A: Adjacency matrix of the graph (dense or sparse).
+    """
+    def __init__(self, A):
+        self.A = csr_matrix(A, dtype=float)
+        self.norm = 1/np.mean(self.A.sum(axis=1))
+        self.work = None
+
+    def __call__(self, x, t, w, k, out=None):
+        n = x.shape[-1]
+        b = x.size//n
+        if self.work is None or self.work.shape != (n, 2*b):
+            self.work = np.empty((n, 2*b))
+        if out is None:
+            out = np.empty_like(x)
+
+        # Columns of the workspace are [sin x, cos x] for each member of the ensemble
+        x_cols = x.reshape(b, n).T
+        np.sin(x_cols, out=self.work[:, :b])
+        np.cos(x_cols, out=self.work[:, b:])
+        sin_x = self.work[:, :b].T.reshape(x.shape)
+        cos_x = self.work[:, b:].T.reshape(x.shape)
+        AS = self.A.dot(self.work)
+        A_sin = AS[:, :b].T.reshape(x.shape)
+        A_cos = AS[:, b:].T.reshape(x.shape)
+
+        # out = w + k*norm*(cos x * A sin x - sin x * A cos x)
+        np.multiply(cos_x, A_sin, out=out)
+        np.multiply(sin_x, A_cos, out=A_cos)
+        out -= A_cos
+        out *= k*self.norm
+        out += w
+
+        return out
 
 def ts_generator(params, counter, lock, L):
     with lock:  # Use explicit lock for thread safety
@@ -32,26 +75,46 @@ def ts_generator(params, counter, lock, L):
     input_, output_, n, i = params
 
     G = nx.read_gml(input_)
-    A = nx.adjacency_matrix(G).toarray()
+    kuramoto = KuramotoCoupling(nx.adjacency_matrix(G))
 
     # Initial conditions and equation parameters
     T, dt = 10, 0.005
+    burn_in, record_every = 0, 1    # transient time discarded and decimation of the stored steps
     x0 = np.random.rand(n)*2*np.pi
     mu, sig = 0, 20
     w = np.random.normal(mu, sig, size=n)
     K_c = 30    # rescaling factor
     K = [0.0, K_c, 1.5*K_c, 2.5*K_c, 5*K_c] # Kuramoto coupling regimes
 
-    # Run the Runge-Kutta for different coupling regimes
+    integrator = os.getenv("INTEGRATOR", "rk4")  # 'rk4' (fixed step) or 'rk45' (adaptive Dormand-Prince)
+    block_size = 200    # number of time steps held in memory by the streaming integrator
+
+    # Header of the stored series: number of samples, sampling interval and run parameters
+    n_samples = len(rk.sampling_grid(T, dt, record_every, burn_in)[1])
+    file_paths, metas = [], []
     for k in K:
         out_folder = os.path.join(output_, "K_{}".format(k/K_c))
         os.makedirs(out_folder, exist_ok=True)
-        t_vals, x_vals = rk.runge_kutta(kuramoto, x0, T, dt = dt, w = w, k = k, A = A)
-
-        # Save the results
-        file_path_out = os.path.join(out_folder, "kuramoto_{}_{}.csv.gz".format(n, i))
-        with gzip.open(file_path_out, "wt") as f:
-            np.savetxt(f, x_vals, delimiter=",")
+        file_paths.append(os.path.join(out_folder, "kuramoto_{}_{}{}".format(n, i, storage.EXT)))
+        metas.append(dict(model="kuramoto", n=n, i=i, K=k/K_c, T=n_samples, dt=dt*record_every, seed=SEED))
+
+    if integrator == "rk45":
+        # The adaptive step is chosen per regime, so each coupling is integrated on its own
+        for k, file_path_out, meta in zip(K, file_paths, metas):
+            t_vals, x_vals, stats = rk.dormand_prince(kuramoto, x0, T, dt = dt, record_every = record_every,
+                                                     burn_in = burn_in, w = w, k = k)
+
+            # Save the results, with the step statistics of the integrator in the header
+            storage.save_array(file_path_out, x_vals, **meta, **stats)
+    else:
+        # Run a single Runge-Kutta for all the coupling regimes stacked in one ensemble
+        # and stream the results to disk while integrating
+        x0_batch = np.tile(x0, (len(K), 1))
+        k_batch = np.reshape(K, (-1, 1))
+        blocks = rk.runge_kutta_blocks(kuramoto, x0_batch, T, dt = dt, block_size = block_size,
+                                       inplace = True, record_every = record_every, burn_in = burn_in,
+                                       w = w, k = k_batch)
+        storage.write_blocks(blocks, file_paths, meta=metas)
 
 def main():
     input_folder = "./graphs"
@@ -1,37 +1,208 @@
 import numpy as np
 
-def runge_kutta(f, x0, T, dt = 0.01, **kwargs):
+def sampling_grid(T, dt, record_every = 1, burn_in = 0):
+    """
+    Integration grid np.arange(0, T, dt) and the indices of the steps that are stored when
+    the first 'burn_in' time units are discarded and only every 'record_every'-th step is kept.
+    """
+    t_values = np.arange(0, T, dt)
+    i0 = int(round(burn_in/dt))
+
+    return t_values, np.arange(i0, len(t_values), record_every)
+
+def runge_kutta(f, x0, T, dt = 0.01, inplace = False, record_every = 1, burn_in = 0, **kwargs):
     """
     Solves the differential equation dx/dt = f(x,t) using the 4th-order Runge-Kutta method.
 
     Parameters:
     - f: Function that computes the derivative (dx/dt) given the current state x at time t.
-    - x0: Initial state vector.
+    - x0: Initial state vector. A stacked state of shape (batch, n) advances an ensemble of
+          independent systems at once: per-member parameters in **kwargs are then passed as
+          arrays that broadcast against the state (e.g. k of shape (batch, 1)).
     - T: Final time.
     - dt: Time step size.
+    - inplace: If True, f is called as f(x, t, out=buffer, **kwargs) and must write the
+               derivative into 'buffer'. The stage vectors are then preallocated once and
+               reused, so the time loop does not allocate any temporary array.
+    - record_every: Only every 'record_every'-th step is stored.
+    - burn_in: Transient time discarded at the beginning of the trajectory.
+    - **kwargs: additional arguments of the force f.
+
+    Returns:
+    - t_values: Array of the stored time points.
+    - x_values: Array of state vectors corresponding to the time points, with shape
+                (len(t_values), *x0.shape).
+    """
+    t_values, idx = sampling_grid(T, dt, record_every, burn_in)
+    x_values = np.zeros((len(idx),) + np.shape(x0))
+
+    i = 0
+    for _, x_block in runge_kutta_blocks(f, x0, T, dt = dt, block_size = 1000, inplace = inplace,
+                                         record_every = record_every, burn_in = burn_in, **kwargs):
+        x_values[i:i + len(x_block)] = x_block
+        i += len(x_block)
+
+    return t_values[idx], x_values
+
+def runge_kutta_blocks(f, x0, T, dt = 0.01, block_size = 100, inplace = False,
+                       record_every = 1, burn_in = 0, **kwargs):
+    """
+    Streaming version of runge_kutta: the trajectory is produced in blocks of at most
+    'block_size' stored time points, so that only one block is held in memory at a time.
+
+    Parameters:
+    - f, x0, T, dt, inplace, record_every, burn_in, **kwargs: see runge_kutta.
+    - block_size: Number of stored time points per block.
+
+    Yields:
+    - t_block: Array of time points of the block.
+    - x_block: Array of state vectors corresponding to the time points, with shape
+               (len(t_block), *x0.shape).
+    """
+    # Initialize time and state
+    t_values, idx = sampling_grid(T, dt, record_every, burn_in)
+    x = np.array(x0, dtype=float)
+
+    if inplace:
+        # Stage workspaces, reused at every step
+        k1, k2, k3, k4, xs = (np.empty_like(x) for _ in range(5))
+
+    # Runge-Kutta iteration, storing only the requested steps
+    i = 0
+    for start in range(0, len(idx), block_size):
+        idx_block = idx[start:start + block_size]
+        x_block = np.zeros((len(idx_block),) + x.shape)
+        for r, i_stored in enumerate(idx_block):
+            while i < i_stored:
+                t = t_values[i]
+
+                if inplace:
+                    f(x, t, out=k1, **kwargs)
+                    k1 *= dt
+                    np.multiply(k1, 0.5, out=xs)
+                    xs += x
+                    f(xs, t, out=k2, **kwargs)
+                    k2 *= dt
+                    np.multiply(k2, 0.5, out=xs)
+                    xs += x
+                    f(xs, t, out=k3, **kwargs)
+                    k3 *= dt
+                    np.add(x, k3, out=xs)
+                    f(xs, t, out=k4, **kwargs)
+                    k4 *= dt
+
+                    # x += (k1 + 2*k2 + 2*k3 + k4) / 6
+                    np.multiply(k2, 2, out=xs)
+                    xs += k1
+                    k3 *= 2
+                    xs += k3
+                    xs += k4
+                    xs /= 6
+                    x += xs
+                else:
+                    k1 = dt * f(x, t, **kwargs)
+                    k2 = dt * f(x + 0.5 * k1, t, **kwargs)
+                    k3 = dt * f(x + 0.5 * k2, t, **kwargs)
+                    k4 = dt * f(x + k3, t, **kwargs)
+
+                    x = x + (k1 + 2*k2 + 2*k3 + k4) / 6
+                i += 1
+            x_block[r] = x
+
+        yield t_values[idx_block], x_block
+
+# Dormand-Prince 5(4) tableau (FSAL), error weights and dense output coefficients
+DP_C = np.array([0, 1/5, 3/10, 4/5, 8/9, 1])
+DP_A = [np.array([]),
+        np.array([1/5]),
+        np.array([3/40, 9/40]),
+        np.array([44/45, -56/15, 32/9]),
+        np.array([19372/6561, -25360/2187, 64448/6561, -212/729]),
+        np.array([9017/3168, -355/33, 46732/5247, 49/176, -5103/18656])]
+DP_B = np.array([35/384, 0, 500/1113, 125/192, -2187/6784, 11/84])
+DP_E = np.array([71/57600, 0, -71/16695, 71/1920, -17253/339200, 22/525, -1/40])
+DP_P = np.array([
+    [1, -8048581381/2820520608, 8663915743/2820520608, -12715105075/11282082432],
+    [0, 0, 0, 0],
+    [0, 131558114200/32700410799, -68118460800/10900136933, 87487479700/32700410799],
+    [0, -1754552775/470086768, 14199869525/1410260304, -10690763975/1880347072],
+    [0, 127303824393/49829197408, -318862633887/49829197408, 701980252875/199316789632],
+    [0, -282668133/205662961, 2019193451/616988883, -1453857185/822651844],
+    [0, 40617522/29380423, -110615467/29380423, 69997945/29380423]])
+
+def dormand_prince(f, x0, T, dt = 0.01, rtol = 1e-6, atol = 1e-6, h0 = None,
+                   record_every = 1, burn_in = 0, **kwargs):
+    """
+    Solves the differential equation dx/dt = f(x,t) using the adaptive Dormand-Prince 5(4) method.
+    The step size is controlled by the embedded 4th-order error estimate, while the solution is
+    sampled on the same fixed grid np.arange(0, T, dt) as runge_kutta through the 4th-order
+    dense output of every accepted step.
+
+    Parameters:
+    - f: Function that computes the derivative (dx/dt) given the current state x at time t.
+    - x0: Initial state vector (or stacked (batch, n) state, in which case the whole batch
+          shares the step size).
+    - T: Final time.
+    - dt: Sampling interval of the output grid.
+    - rtol, atol: Relative and absolute tolerances of the error control.
+    - h0: Initial step size. Default is dt.
+    - record_every, burn_in: Only the points of the output grid kept by runge_kutta with the
+                             same options are sampled.
     - **kwargs: additional arguments of the force f.
 
     Returns:
-    - t_values: Array of time points.
+    - t_values: Array of the stored time points.
     - x_values: Array of state vectors corresponding to the time points.
+    - stats: Dictionary with the number of accepted steps ('n_steps'), rejected steps
+             ('n_rejected') and evaluations of f ('n_fevals').
     """
     # Initialize time and state
-    t_values = np.arange(0, T, dt)
-    x_values = np.zeros((len(t_values), len(x0)))
-
-    x = np.array(x0)
-    x_values[0] = x
-
-    # Runge-Kutta iteration
-    for i in range(1, len(t_values)):
-        t = t_values[i-1]
-        
-        k1 = dt * f(x, t, **kwargs)
-        k2 = dt * f(x + 0.5 * k1, t, **kwargs)
-        k3 = dt * f(x + 0.5 * k2, t, **kwargs)
-        k4 = dt * f(x + k3, t, **kwargs)
-        
-        x = x + (k1 + 2*k2 + 2*k3 + k4) / 6
-        x_values[i] = x
-
-    return t_values, x_values
+    t_values, idx = sampling_grid(T, dt, record_every, burn_in)
+    t_values = t_values[idx]
+    x = np.array(x0, dtype=float)
+    x_values = np.zeros((len(t_values),) + x.shape)
+
+    K = np.zeros((7,) + x.shape)
+    K[0] = f(x, 0., **kwargs)
+    stats = {'n_steps': 0, 'n_rejected': 0, 'n_fevals': 1}
+
+    t, t_end = 0., t_values[-1]
+    h = dt if h0 is None else h0
+    j = np.searchsorted(t_values, t, side='right')  # index of the next sample to fill
+    x_values[:j] = x
+    while j < len(t_values):
+        last = h >= t_end - t
+        if last:
+            h = t_end - t
+
+        # Runge-Kutta stages
+        for s in range(1, 6):
+            K[s] = f(x + h*np.tensordot(DP_A[s], K[:s], axes=1), t + DP_C[s]*h, **kwargs)
+        x_new = x + h*np.tensordot(DP_B, K[:6], axes=1)
+        K[6] = f(x_new, t + h, **kwargs)
+        stats['n_fevals'] += 6
+
+        # Error control
+        scale = atol + rtol*np.maximum(np.abs(x), np.abs(x_new))
+        err_norm = np.sqrt(np.mean((h*np.tensordot(DP_E, K, axes=1)/scale)**2))
+
+        if err_norm <= 1:
+            t_new = t_end if last else t + h
+
+            # Dense output onto the samples covered by the step
+            j_new = j + np.searchsorted(t_values[j:], t_new, side='right')
+            theta = (t_values[j:j_new] - t)/h
+            Q = np.tensordot(DP_P.T, K, axes=1)
+            x_values[j:j_new] = x + h*np.tensordot(theta[:, np.newaxis]**np.arange(1, 5), Q, axes=1)
+            j = j_new
+
+            t, x = t_new, x_new
+            K[0] = K[6]
+            stats['n_steps'] += 1
+            factor = 10 if err_norm == 0 else min(10, 0.9*err_norm**-0.2)
+        else:
+            stats['n_rejected'] += 1
+            factor = max(0.2, 0.9*err_norm**-0.2)
+        h *= factor
+
+    return t_values, x_values, stats
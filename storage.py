@@ -0,0 +1,547 @@
+# Binary storage format shared by all the stages of the pipeline (time series, correlation
+# matrices, ...), replacing the gzip-compressed csv files.
+#
+# Layout of a file:
+#   MAGIC | header size (uint32, little endian) | json header (padded with spaces) | data
+# The header describes the array (shape, dtype, compression) together with the metadata of
+# the run that produced it (T, n, model, K, seed, ...). The data is the C-ordered array,
+# either raw, so that it can be memory-mapped, or as a sequence of zlib-compressed chunks,
+# each preceded by its size in bytes and its number of rows (two uint64).
+#
+# Spike trains are stored as sparse matrices in scipy's .npz format, with the metadata of the run
+# as an extra field (see save_spikes).
+#
+# The same module holds the columnar results table of the global measures (see ResultsWriter).
+#
+# Usage as a script converts the existing .csv.gz archives of a folder:
+#   python storage.py /mnt/time_series/kuramoto [--compression zlib] [--T 2000] [--triu] [--remove]
+# Time series and spike trains get T from their number of rows, correlation matrices from --T.
+
+import os
+import sys
+import gzip
+import json
+import zlib
+import struct
+import argparse
+import numpy as np
+from functools import lru_cache
+from scipy.sparse import csr_matrix
+
+EXT = ".bin"
+MAGIC = b"PRJCORR1"
+HEADER_SIZE = 4096  # bytes reserved for the json header, so it can be rewritten in place
+COMPRESSIONS = (None, "zlib")
+
+_PREFIX = struct.Struct("<I")
+_CHUNK = struct.Struct("<QQ")
+
+def _to_json(meta):
+    return json.dumps(meta, default=lambda o: o.item())  # numpy scalars as python ones
+
+def _write_header(f, header):
+    text = _to_json(header).encode()
+    if len(text) > HEADER_SIZE:
+        raise ValueError(f"Header too large ({len(text)} > {HEADER_SIZE} bytes)")
+    f.seek(0)
+    f.write(MAGIC + _PREFIX.pack(HEADER_SIZE) + text.ljust(HEADER_SIZE))
+
+def _read_header(f):
+    magic = f.read(len(MAGIC))
+    if magic != MAGIC:
+        raise ValueError(f"{getattr(f, 'name', 'file')} is not a {EXT} array file")
+    size, = _PREFIX.unpack(f.read(_PREFIX.size))
+    header = json.loads(f.read(size).decode())
+
+    return header, len(MAGIC) + _PREFIX.size + size
+
+class ArrayWriter:
+    """
+    Writes an array to disk one block of rows at a time, so that it never has to be held in
+    memory as a whole. The shape in the header is updated when the writer is closed.
+
+    Args:
+        file_path (str): Output file.
+        compression (str): None (raw data, memory-mappable) or 'zlib'.
+        level (int): zlib compression level. The default favours speed.
+        **meta: Metadata stored in the header (e.g. T, n, model, K, seed).
+    """
+    def __init__(self, file_path, compression = None, level = 1, **meta):
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression {compression!r}, expected one of {COMPRESSIONS}")
+        self.file_path = file_path
+        self.compression = compression
+        self.level = level
+        self.meta = meta
+        self.dtype = None
+        self.row_shape = None
+        self.n_rows = 0
+        self.f = open(file_path, "wb")
+        self._flush_header()
+
+    def _flush_header(self):
+        header = dict(self.meta)
+        header.update(shape = [self.n_rows] + list(self.row_shape or []),
+                      dtype = None if self.dtype is None else self.dtype.str,
+                      compression = self.compression)
+        pos = self.f.tell()
+        _write_header(self.f, header)
+        self.f.seek(max(pos, self.f.tell()))
+
+    def append(self, block):
+        """
+        Appends the rows of 'block'. The first block fixes the dtype and the shape of a row.
+        """
+        block = np.ascontiguousarray(block)
+        if self.dtype is None:
+            self.dtype, self.row_shape = block.dtype, block.shape[1:]
+        elif block.shape[1:] != self.row_shape:
+            raise ValueError(f"Block rows of shape {block.shape[1:]}, expected {self.row_shape}")
+        block = block.astype(self.dtype, copy=False)
+
+        if self.compression == "zlib":
+            data = zlib.compress(block.tobytes(), self.level)
+            self.f.write(_CHUNK.pack(len(data), len(block)))
+            self.f.write(data)
+        else:
+            self.f.write(block.tobytes())
+        self.n_rows += len(block)
+
+    def close(self):
+        if not self.f.closed:
+            self._flush_header()
+            self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def save_array(file_path, array, compression = None, **meta):
+    """
+    Saves a whole array (see ArrayWriter for the arguments).
+    """
+    with ArrayWriter(file_path, compression = compression, **meta) as writer:
+        writer.append(array)
+
+def load_header(file_path):
+    """
+    Reads the header of an array file.
+    Returns:
+        dict: shape, dtype, compression and the metadata of the run.
+    """
+    with open(file_path, "rb") as f:
+        header, _ = _read_header(f)
+
+    return header
+
+def load_array(file_path, mmap = True):
+    """
+    Loads an array file.
+    Args:
+        file_path (str): Input file.
+        mmap (bool): If True and the data is not compressed, the array is a read-only
+                     np.memmap of the file, so nothing is read until it is accessed.
+    Returns:
+        np.ndarray: The stored array.
+    """
+    with open(file_path, "rb") as f:
+        header, offset = _read_header(f)
+        shape, dtype = tuple(header["shape"]), np.dtype(header["dtype"])
+
+        if header["compression"] == "zlib":
+            x = np.empty(shape, dtype=dtype)
+            flat = x.reshape(shape[0], -1) if x.size else x
+            i = 0
+            while i < shape[0]:
+                size, rows = _CHUNK.unpack(f.read(_CHUNK.size))
+                flat[i:i + rows] = np.frombuffer(zlib.decompress(f.read(size)), dtype=dtype).reshape(rows, -1)
+                i += rows
+            return x
+
+        if mmap and np.prod(shape) > 0:
+            return np.memmap(f, dtype=dtype, mode="r", offset=offset, shape=shape)
+        f.seek(offset)
+        return np.fromfile(f, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+def write_blocks(blocks, file_paths, compression = None, meta = None):
+    """
+    Appends the blocks produced by runge_kutta.runge_kutta_blocks to array files as they are
+    produced, so the whole trajectory is never held in memory.
+    Args:
+        blocks: Iterable of (t_block, x_block).
+        file_paths (str or list): Output file path, or list of paths (one per member) for a
+                                  stacked (batch, n) state.
+        compression (str): See ArrayWriter.
+        meta (dict or list): Header metadata, or list of metadata (one per member).
+    Returns:
+        int: Number of time points written.
+    """
+    batched = not isinstance(file_paths, str)
+    paths = file_paths if batched else [file_paths]
+    metas = meta if isinstance(meta, (list, tuple)) else [meta or {}]*len(paths)
+    writers = [ArrayWriter(path, compression = compression, **m) for path, m in zip(paths, metas)]
+    n_rows = 0
+    try:
+        for _, x_block in blocks:
+            for j, writer in enumerate(writers):
+                writer.append(x_block[:, j, :] if batched else x_block)
+            n_rows += len(x_block)
+    finally:
+        for writer in writers:
+            writer.close()
+
+    return n_rows
+
+# Symmetric matrices with unit diagonal (correlation matrices) are stored as their strict upper
+# triangle, packed row by row in a vector of n(n-1)/2 entries.
+
+@lru_cache(maxsize=8)
+def triu_indices(n):
+    """
+    Row and column indices of the packed strict upper triangle of an n x n matrix (cached,
+    read-only).
+    """
+    rows, cols = np.triu_indices(n, 1)
+    rows.flags.writeable = False
+    cols.flags.writeable = False
+
+    return rows, cols
+
+def triu_n(size):
+    """
+    Size n of the matrix whose packed strict upper triangle has 'size' entries.
+    """
+    n = int(round((1 + np.sqrt(1 + 8*size))/2))
+    if n*(n - 1)//2 != size:
+        raise ValueError(f"{size} is not the size of a packed triangle")
+
+    return n
+
+def pack_triu(matrix):
+    """
+    Packs the strict upper triangle of a square matrix into a vector.
+    """
+    return np.asarray(matrix)[triu_indices(len(matrix))]
+
+def unpack_triu(packed, diag = 1., out = None):
+    """
+    Rebuilds the dense symmetric matrix from its packed strict upper triangle.
+    Args:
+        packed (np.ndarray): Packed triangle.
+        diag (float): Value of the diagonal.
+        out (np.ndarray): Optional n x n array to fill, to avoid allocating a new one.
+    Returns:
+        np.ndarray: The n x n matrix.
+    """
+    n = triu_n(len(packed))
+    if out is None:
+        out = np.empty((n, n), dtype=np.result_type(packed))
+    rows, cols = triu_indices(n)
+    out[rows, cols] = packed
+    out[cols, rows] = packed
+    np.fill_diagonal(out, diag)
+
+    return out
+
+def save_triu(file_path, matrix, compression = None, **meta):
+    """
+    Saves a symmetric matrix with unit diagonal as its packed strict upper triangle.
+    """
+    save_array(file_path, pack_triu(matrix), compression = compression, packed = "triu", **meta)
+
+def load_triu(file_path, mmap = True):
+    """
+    Loads the packed strict upper triangle of a stored symmetric matrix (packing it if the
+    file holds the dense matrix).
+    """
+    x = load_array(file_path, mmap = mmap)
+
+    return x if load_header(file_path).get("packed") == "triu" else pack_triu(x)
+
+def load_matrix(file_path):
+    """
+    Loads a stored matrix as a dense array, unpacking it if it is stored as a packed triangle.
+    """
+    x = load_array(file_path)
+
+    return unpack_triu(x) if load_header(file_path).get("packed") == "triu" else np.array(x)
+
+def save_spikes(file_path, spikes, **meta):
+    """
+    Saves spike trains, a sparse matrix of shape (n, T) whose row j holds the sample indices of the
+    spikes of neuron j, as a CSR matrix in scipy's .npz format (readable by scipy.sparse.load_npz),
+    with the metadata of the run (model, n, i, K, T, dt, seed, ...) stored as a json field.
+    """
+    S = csr_matrix(spikes)
+    np.savez_compressed(file_path, format=b"csr", shape=S.shape, data=S.data, indices=S.indices,
+                        indptr=S.indptr, meta=_to_json(meta))
+
+def load_spikes(file_path):
+    """
+    Loads spike trains saved by save_spikes.
+    Returns:
+        csr_matrix, dict: Spike trains of shape (n, T) and the metadata of the run.
+    """
+    with np.load(file_path) as f:
+        S = csr_matrix((f["data"], f["indices"], f["indptr"]), shape=tuple(f["shape"]))
+        meta = json.loads(f["meta"].item()) if "meta" in f else {}
+
+    return S, meta
+
+def csv_meta(file_path):
+    """
+    Metadata recoverable from the path of an archive, i.e. ".../K_{K}/{model}_{n}_{i}.csv.gz".
+    """
+    folder, file_name = os.path.split(file_path)
+    model, n_str, i_str = file_name[:-len(".csv.gz")].split("_")
+    meta = {"model": model, "n": int(n_str), "i": int(i_str)}
+    K_str = os.path.basename(folder)
+    if K_str.startswith("K_"):
+        meta["K"] = float(K_str[2:])
+
+    return meta
+
+def csv_kind(file_path):
+    """
+    Content of an archive from its place in the folders of the pipeline: correlation matrices
+    (".../corr_matrices/..."), spike trains (".../spike_trains/...") or time series.
+    """
+    parts = os.path.normpath(file_path).split(os.sep)
+    if "corr_matrices" in parts:
+        return "matrix"
+
+    return "spikes" if "spike_trains" in parts else "series"
+
+def convert_csv(input_file, output_file = None, compression = None, triu = False, series = False, **meta):
+    """
+    Converts a gzip-compressed csv archive to the binary format, streaming it in blocks.
+    If 'triu' is True the archive holds a symmetric matrix, which is stored as its packed
+    strict upper triangle (see save_triu). If 'series' is True it holds a time series, whose
+    number of rows is stored as T.
+    Returns:
+        str: Path of the converted file.
+    """
+    if output_file is None:
+        output_file = input_file[:-len(".csv.gz")] + EXT
+    if triu:
+        meta["packed"] = "triu"
+
+    with gzip.open(input_file, "rt") as f, ArrayWriter(output_file, compression = compression, **meta) as writer:
+        block = []
+        for r, line in enumerate(f):
+            row = np.array(line.split(","), dtype=float)
+            block.append(row[r + 1:] if triu else row)
+            if len(block) == 1000:
+                writer.append(np.concatenate(block) if triu else np.array(block))
+                block = []
+        if triu:
+            writer.append(np.concatenate(block) if block else np.zeros(0))
+        elif block or writer.n_rows == 0:
+            writer.append(np.array(block).reshape(len(block), -1))
+        if series:
+            writer.meta["T"] = writer.n_rows
+
+    return output_file
+
+def convert_spikes(input_file, output_file = None, **meta):
+    """
+    Converts a gzip-compressed csv archive of binary spike trains, one row per sample and one
+    column per neuron, to the sparse .npz format (see save_spikes). T is the number of rows.
+    Returns:
+        str: Path of the converted file.
+    """
+    if output_file is None:
+        output_file = input_file[:-len(".csv.gz")] + ".npz"
+
+    neurons, rows, n, T = [], [], 0, 0
+    with gzip.open(input_file, "rt") as f:
+        for line in f:
+            row = np.array(line.split(","), dtype=float)
+            spiking = np.flatnonzero(row)
+            neurons.append(spiking)
+            rows.append(np.full(len(spiking), T))
+            n, T = len(row), T + 1
+    neurons = np.concatenate(neurons) if neurons else np.zeros(0, dtype=np.int64)
+    rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+    meta["T"] = T
+    S = csr_matrix((np.ones(len(neurons)), (neurons, rows)), shape=(n, T))
+    save_spikes(output_file, S, **meta)
+
+    return output_file
+
+# Results table of the global measures: an append-only columnar store with one row per
+# (model, K, N, replica, method, threshold, measure). A table is a folder holding one raw file
+# per column, which can be memory-mapped on its own, and a json schema with the dtypes, the
+# categories of the string columns (stored as uint16 codes) and the number of committed rows.
+# The schema is rewritten after the columns, so an interrupted append is simply discarded.
+# The networks of the original graphs have K = nan, method = "original" and threshold = nan.
+
+RESULT_COLUMNS = {"model": "category", "K": "<f8", "N": "<i4", "replica": "<i4", "method": "category",
+                  "threshold": "<f8", "measure": "category", "value": "<f8", "error": "<f8"}
+SCHEMA = "schema.json"
+_CODE = np.dtype("<u2")
+
+def _column_dtype(kind):
+    return _CODE if kind == "category" else np.dtype(kind)
+
+def _column_path(table_path, column):
+    return os.path.join(table_path, column + ".col")
+
+def load_schema(table_path):
+    """
+    Reads the schema of a results table (columns, categories and number of rows).
+    """
+    with open(os.path.join(table_path, SCHEMA)) as f:
+        return json.load(f)
+
+class ResultsWriter:
+    """
+    Appends rows to a results table (see RESULT_COLUMNS). Only one process may write to a
+    table at a time.
+
+    Args:
+        table_path (str): Folder of the table.
+        mode (str): 'a' appends to the existing table (if any), 'w' starts a new one.
+    """
+    def __init__(self, table_path, mode = "a"):
+        if mode not in ("a", "w"):
+            raise ValueError(f"Unknown mode {mode!r}, expected 'a' or 'w'")
+        os.makedirs(table_path, exist_ok=True)
+        self.table_path = table_path
+        if mode == "a" and os.path.exists(os.path.join(table_path, SCHEMA)):
+            self.schema = load_schema(table_path)
+        else:
+            self.schema = {"columns": RESULT_COLUMNS, "n_rows": 0,
+                           "categories": {c: [] for c, kind in RESULT_COLUMNS.items() if kind == "category"}}
+        self.codes = {c: {v: i for i, v in enumerate(cats)} for c, cats in self.schema["categories"].items()}
+
+        # Drop whatever was written after the last committed row
+        self.files = {}
+        for c, kind in self.schema["columns"].items():
+            self.files[c] = open(_column_path(table_path, c), "ab" if mode == "a" else "wb")
+            self.files[c].truncate(self.schema["n_rows"]*_column_dtype(kind).itemsize)
+        self._write_schema()
+
+    def _write_schema(self):
+        tmp = os.path.join(self.table_path, SCHEMA + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(self.schema, f)
+        os.replace(tmp, os.path.join(self.table_path, SCHEMA))
+
+    def _encode(self, column, values):
+        codes = self.codes[column]
+        for v in values:
+            if v not in codes:
+                codes[v] = len(codes)
+                self.schema["categories"][column].append(v)
+        if len(codes) > np.iinfo(_CODE).max + 1:
+            raise ValueError(f"Too many categories in column {column!r}")
+        return np.array([codes[v] for v in values], dtype=_CODE)
+
+    def append(self, rows):
+        """
+        Appends and commits a list of rows, each a tuple of values in the order of the columns.
+        """
+        if len(rows) == 0:
+            return
+        for c, values in zip(self.schema["columns"], zip(*rows)):
+            kind = self.schema["columns"][c]
+            data = self._encode(c, [str(v) for v in values]) if kind == "category" else np.array(values, dtype=kind)
+            self.files[c].write(data.tobytes())
+            self.files[c].flush()
+        self.schema["n_rows"] += len(rows)
+        self._write_schema()
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def load_results(table_path, columns = None, rows = None, **where):
+    """
+    Loads some columns of a results table, reading only what is needed.
+    Args:
+        table_path (str): Folder of the table.
+        columns (list): Columns to load. Default is all of them.
+        rows (slice): Range of rows to consider. Default is all of them.
+        **where: Keep only the rows where a column equals a value, or is in a list of values
+                 (e.g. measure="Modularity", K=[1.0, 2.5]). nan matches nan, so that K=np.nan
+                 selects the original networks.
+    Returns:
+        dict: Array of each column (strings for the category columns).
+    """
+    schema = load_schema(table_path)
+    kinds = schema["columns"]
+    n_rows = schema["n_rows"]
+    columns = list(kinds) if columns is None else columns
+    rows = slice(None) if rows is None else rows
+
+    def column(c):
+        dtype = _column_dtype(kinds[c])
+        if n_rows == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(_column_path(table_path, c), dtype=dtype, mode="r", shape=(n_rows,))[rows]
+
+    mask = None
+    for c, value in where.items():
+        values = value if isinstance(value, (list, tuple)) else [value]
+        x = column(c)
+        if kinds[c] == "category":
+            cats = schema["categories"][c]
+            keep = np.isin(x, [cats.index(str(v)) for v in values if str(v) in cats])
+        else:
+            keep = np.isin(x, values)
+            if np.isnan(np.array(values, dtype=float)).any():
+                keep |= np.isnan(x)  # e.g. K=np.nan selects the original networks
+        mask = keep if mask is None else mask & keep
+
+    out = {}
+    for c in columns:
+        x = column(c)
+        x = np.array(x if mask is None else x[mask])
+        if kinds[c] == "category":
+            x = np.array(schema["categories"][c], dtype=str)[x]
+        out[c] = x
+    return out
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert the .csv.gz archives of a folder (recursively) to the binary format.")
+    parser.add_argument("input_folder", type=str, help="Folder containing the .csv.gz files")
+    parser.add_argument("--compression", type=str, default=None, choices=["zlib"], help="Compress the converted files")
+    parser.add_argument("--T", type=int, default=None, help="Length of the underlying time series, stored for correlation matrices")
+    parser.add_argument("--kind", type=str, default=None, choices=["series", "spikes", "matrix"],
+                        help="Content of the archives. Inferred from their path by default (see csv_kind)")
+    parser.add_argument("--triu", action="store_true", help="Pack the (symmetric) correlation matrices as upper triangles")
+    parser.add_argument("--remove", action="store_true", help="Remove the archives once converted")
+    args = parser.parse_args()
+
+    file_list = [os.path.join(root, file_name)
+                 for root, _, files in os.walk(args.input_folder)
+                 for file_name in files if file_name.endswith(".csv.gz")]
+
+    for c, file_path in enumerate(file_list):
+        print(f"Converting... {c + 1}/{len(file_list)}", end="\r")
+        meta = csv_meta(file_path)
+        kind = args.kind or ("matrix" if args.triu else csv_kind(file_path))
+        if kind == "spikes":
+            # Spike trains are read by LIF/ts_corr.py in the sparse .npz format
+            convert_spikes(file_path, **meta)
+        else:
+            if kind == "matrix" and args.T is not None:
+                meta["T"] = args.T
+            convert_csv(file_path, compression = args.compression, triu = args.triu, series = kind == "series", **meta)
+        if args.remove:
+            os.remove(file_path)
+
+    sys.stdout.write("\r" + " " * 50 + "\r")  # Clear the line by overwriting with spaces
+    print('Done!')
+
+if __name__ == "__main__":
+    main()
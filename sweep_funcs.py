@@ -0,0 +1,291 @@
+# Module which contains functions to compute global measures incrementally along a threshold sweep.
+# The networks of the thresholds of one filtering method are nested (see filter_func.apply_thresh),
+# so the measures are updated while the edges are added in threshold order instead of being
+# recomputed from scratch for every network.
+# The percolation curve of a correlation matrix, over the whole ordering of its edges by weight,
+# is computed in the same way with a union-find.
+
+import os
+import numpy as np
+from itertools import chain
+
+import storage
+
+# Measures of global_funcs.MEASURES that the sweep engine can update incrementally
+INCREMENTAL_MEASURES = ['Mean_degree', 'MR_coefficient', 'Global_clustering', 'Assortativity', 'Components']
+
+class UnionFind:
+    """
+    Disjoint-set forest (union by size, path halving) tracking the connected components of a
+    graph while edges are added.
+    """
+    def __init__(self, n):
+        self.parent = list(range(n))
+        self.size = [1]*n
+        self.n_components = n
+        self.giant = 1 if n else 0
+
+    def find(self, x):
+        parent = self.parent
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def union(self, x, y):
+        """
+        Merges the components of x and y. Returns the size of the merged component, or 0 if x and
+        y were already connected.
+        """
+        rx, ry = self.find(x), self.find(y)
+        if rx == ry:
+            return 0
+        if self.size[rx] < self.size[ry]:
+            rx, ry = ry, rx
+        self.parent[ry] = rx
+        self.size[rx] += self.size[ry]
+        self.n_components -= 1
+        self.giant = max(self.giant, self.size[rx])
+        return self.size[rx]
+
+class IncrementalGraph:
+    """
+    Undirected graph on n vertices grown by batches of edges, keeping up to date the quantities the
+    global measures are made of. The cost of a batch only depends on the new edges and on the
+    edges incident to the vertices they touch, never on the rest of the graph:
+    - the adjacency sets and the degree sequence;
+    - the number of triangles through every vertex, from the common neighbours of the ends of
+      each new edge;
+    - the number of edges joining each pair of degrees that occurs in the graph (degree
+      assortativity), updated on the edges incident to the vertices whose degree changed;
+    - the connected components (union-find).
+    """
+    def __init__(self, n):
+        self.n = n
+        self.adj = [set() for _ in range(n)]
+        self.degrees = np.zeros(n, dtype=np.int64)
+        self.triangles = np.zeros(n)
+        self.n_edges = 0
+        self.joint = {}  # edges joining the degrees j <= k, keyed by j*n + k
+        self.components = UnionFind(n)
+
+    def _incident(self, nodes):
+        # Edges (u, w) incident to 'nodes', one per vertex u of 'nodes' and neighbour w
+        lens = [len(self.adj[u]) for u in nodes.tolist()]
+        nbrs = np.fromiter(chain.from_iterable(self.adj[u] for u in nodes.tolist()), dtype=np.int64, count=sum(lens))
+        return np.repeat(nodes, lens), nbrs
+
+    def _count_pairs(self, j, k, w):
+        # Adds the weights w to the degree pairs (j, k), dropping the pairs left empty
+        keys, inv = np.unique(np.minimum(j, k)*self.n + np.maximum(j, k), return_inverse=True)
+        counts = np.rint(np.bincount(inv, weights=w)).astype(np.int64)
+        joint = self.joint
+        for key, c in zip(keys.tolist(), counts.tolist()):
+            if c:
+                c += joint.get(key, 0)
+                if c:
+                    joint[key] = c
+                else:
+                    del joint[key]
+
+    def add_edges(self, rows, cols):
+        """
+        Adds the edges (rows[e], cols[e]), which must not be in the graph yet.
+        """
+        rows, cols = np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64)
+        if len(rows) == 0:
+            return
+        adj, triangles = self.adj, self.triangles
+        ends = np.r_[rows, cols]
+        touched = np.unique(ends)
+        in_touched = np.zeros(self.n, dtype=bool)
+        in_touched[touched] = True
+
+        # Pairs of degrees of the edges incident to the touched vertices, before and after the batch
+        # (edges with both ends in 'touched' are seen twice)
+        src, nbrs = self._incident(touched)
+        w = np.where(in_touched[nbrs], .5, 1.)
+        old = self.degrees
+        new = old + np.bincount(ends, minlength=self.n)
+        self._count_pairs(np.r_[old[src], new[src], new[rows]], np.r_[old[nbrs], new[nbrs], new[cols]],
+                          np.r_[-w, w, np.ones(len(rows))])
+        self.degrees = new
+
+        for u, v in zip(rows.tolist(), cols.tolist()):
+            # Triangles closed by the new edge
+            common = adj[u] & adj[v]
+            if common:
+                triangles[list(common)] += 1
+                triangles[u] += len(common)
+                triangles[v] += len(common)
+            adj[u].add(v)
+            adj[v].add(u)
+            self.components.union(u, v)
+        self.n_edges += len(rows)
+
+    def clustering(self):
+        """
+        Global clustering coefficient and its jackknife error, in the form of graph_tool's
+        global_clustering.
+        """
+        triples = self.degrees*(self.degrees - 1)/2
+        t, p = self.triangles.sum(), triples.sum()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            c = t/p
+            c_l = (t - self.triangles)/(p - triples)
+        return (c, np.sqrt(np.sum((c - c_l)**2)))
+
+    def assortativity(self):
+        """
+        Categorical assortativity of the degrees and its jackknife error over the edges, in the form
+        of graph_tool's assortativity(g, "total"). The jackknife only depends on the degrees at the
+        ends of each edge, so it is summed over the pairs of degrees that occur. Like graph_tool, it
+        is nan when the degrees have no variance (no edges, or all of them joining vertices of one
+        degree).
+        """
+        k = self.degrees
+        m2 = np.float64(2*self.n_edges)  # number of edge ends
+        a = np.bincount(k, weights=k)  # edge ends attached to vertices of each degree
+        t2 = np.sum(a**2)/m2**2 if m2 else 1.
+        if t2 >= 1:
+            return (np.nan, np.nan)
+        keys = np.fromiter(self.joint.keys(), dtype=np.int64, count=len(self.joint))
+        c = np.fromiter(self.joint.values(), dtype=np.float64, count=len(self.joint))
+        j, l = np.divmod(keys, self.n)
+        j, l, c = np.r_[j, l], np.r_[l, j], np.r_[c, c]  # both directions of every edge
+        t1 = np.sum(c[j == l])/m2
+        r = (t1 - t2)/(1 - t2)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t2_l = (t2*m2**2 - a[j] - a[l])/(m2 - 1)**2
+            t1_l = (t1*m2 - (j == l))/(m2 - 1)
+            r_l = np.where(t2_l < 1, (t1_l - t2_l)/(1 - t2_l), 0.)
+        return (r, np.sqrt(np.sum(c*(r - r_l)**2)))
+
+    def measures(self, names = INCREMENTAL_MEASURES):
+        """
+        Current values of the requested incremental measures, with the keys of
+        global_funcs.compute_global_variables.
+        """
+        k = self.degrees
+        values = {}
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if 'Mean_degree' in names:
+                values['Mean_degree'] = np.mean(k)
+            if 'MR_coefficient' in names:
+                values['MR_coefficient'] = np.mean(k**2)/np.mean(k)
+        if 'Global_clustering' in names:
+            values['Global_clustering'] = self.clustering()
+        if 'Assortativity' in names:
+            values['Assortativity'] = self.assortativity()
+        if 'Components' in names:
+            values['N_components'] = self.components.n_components
+            values['Giant_component'] = self.components.giant
+        return values
+
+def sweep_measures(n, edges, measures = INCREMENTAL_MEASURES):
+    """
+    Incremental measures of the networks of every threshold of one filtering method.
+    Args:
+        n (int): Number of nodes.
+        edges (dict): Sorted edges and cuts of the method (see filter_func.load_sweep).
+        measures (list): Names of the measures to evaluate (among INCREMENTAL_MEASURES).
+    Returns:
+        list: Dictionary of the measures of each threshold, in the order of edges["thresholds"].
+    """
+    cuts = edges["cuts"]
+    results = [None]*len(cuts)
+    graph = IncrementalGraph(n)
+    done = 0
+    for j in np.argsort(cuts, kind='stable'):
+        graph.add_edges(edges["rows"][done:cuts[j]], edges["cols"][done:cuts[j]])
+        done = max(done, cuts[j])
+        results[j] = graph.measures(measures)
+    return results
+
+def percolation_curve(n, rows, cols, weights = None):
+    """
+    Percolation of a graph whose edges (rows[e], cols[e]) are added one at a time in the given
+    order, in O(E alpha(n)). The curve only changes when an edge merges two components, so it is
+    stored at these merge points only (at most n-1) and the value after any number of edges is
+    the one of the last merge before it (see percolation_at).
+    The susceptibility is the mean size of the finite clusters, sum of s^2 over the components
+    other than the giant one, divided by n.
+    Args:
+        n (int): Number of nodes.
+        rows, cols (np.ndarray): Ends of the edges, in order of addition.
+        weights (np.ndarray): Optional weights of the edges, stored at the merge points.
+    Returns:
+        dict: 'n' and, at every merge, the number of edges added ('edges'), the weight of the
+              merging edge ('weights', if given), the size of the giant component ('giant') and
+              the susceptibility ('susceptibility').
+    """
+    m = max(n - 1, 0)
+    edges = np.zeros(m, dtype=np.int64)
+    giant = np.zeros(m, dtype=np.int64)
+    chi = np.zeros(m)
+    uf = UnionFind(n)
+    size = uf.size
+    sum_sq = n  # sum of the squared sizes of the components
+
+    k = 0
+    for e, (u, v) in enumerate(zip(np.asarray(rows).tolist(), np.asarray(cols).tolist())):
+        ru, rv = uf.find(u), uf.find(v)
+        if ru == rv:
+            continue
+        sum_sq += 2*size[ru]*size[rv]
+        uf.union(ru, rv)
+        edges[k], giant[k], chi[k] = e + 1, uf.giant, (sum_sq - uf.giant**2)/n
+        k += 1
+        if k == m:  # connected: no further edge changes the curve
+            break
+
+    curve = {'n': n, 'edges': edges[:k], 'giant': giant[:k], 'susceptibility': chi[:k]}
+    if weights is not None:
+        curve['weights'] = np.asarray(weights)[edges[:k] - 1]
+    return curve
+
+def matrix_percolation(packed):
+    """
+    Percolation curve of a correlation matrix, adding the edges of its packed strict upper
+    triangle (see storage.pack_triu) by decreasing weight.
+    """
+    n = storage.triu_n(len(packed))
+    rows, cols = storage.triu_indices(n)
+    order = np.argsort(-np.asarray(packed), kind='stable')
+    return percolation_curve(n, rows[order], cols[order], np.asarray(packed)[order])
+
+def percolation_at(curve, n_edges):
+    """
+    Giant component size, number of components and susceptibility after adding 'n_edges' edges
+    (scalar or array) to the graph of a percolation curve.
+    """
+    n = curve['n']
+    j = np.searchsorted(curve['edges'], n_edges, side='right')  # number of merges so far
+    giant = np.r_[min(n, 1), curve['giant']][j]
+    chi = np.r_[(n - 1)/n if n else 0., curve['susceptibility']][j]
+    return giant, n - j, chi
+
+def save_percolation(file_path, curve):
+    """
+    Saves a percolation curve (see percolation_curve) to an .npz file.
+    """
+    np.savez(file_path, **curve)
+
+def load_percolation(file_path):
+    """
+    Loads a percolation curve saved by save_percolation.
+    """
+    with np.load(file_path) as data:
+        curve = {key: data[key] for key in data.files}
+    curve['n'] = int(curve['n'])
+    return curve
+
+def apply_percolation(input_file, output_path):
+    """
+    Computes the percolation curve of a stored correlation matrix and saves it to
+    output_path/base_name.npz.
+    """
+    base_name = os.path.splitext(os.path.basename(input_file))[0]
+    curve = matrix_percolation(storage.load_triu(input_file, mmap = False))
+    save_percolation(os.path.join(output_path, base_name + ".npz"), curve)
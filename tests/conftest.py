@@ -0,0 +1,14 @@
+import os
+import sys
+import importlib.util
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+def load_script(rel_path):
+    # The model folders all have scripts with the same names, so they are loaded by path
+    name = rel_path.replace('/', '_')[:-len('.py')]
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, rel_path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
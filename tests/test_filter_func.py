@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+import filter_func as ff
+import storage
+
+def correlation(n, T, seed, decimals=None):
+    # Correlation matrix of n noisy series sharing a common mode, optionally rounded to create ties
+    rng = np.random.default_rng(seed)
+    x = rng.standard_normal((T, n)) + rng.standard_normal((T, 1))
+    C = np.corrcoef(x.T)
+    C = (C + C.T)/2
+    np.fill_diagonal(C, 1.)
+    return C if decimals is None else np.round(C, decimals)
+
+def baseline_rmt(C, q):
+    # Original cleaning: subtract every eigenmode below the Marchenko-Pastur edge
+    eVal, eVec = ff.getPCA(C)
+    eMax = (1 + (1./q)**.5)**2
+    C_RMT = np.copy(C)
+    for i, eig in enumerate(eVal):
+        if eig < eMax:
+            v = eVec[:, i:i + 1]
+            C_RMT -= eig*np.dot(v, v.T)
+    return C_RMT
+
+@pytest.mark.parametrize("solver", ["full", "range", "lanczos"])
+def test_rmt_filter_matches_dense_cleaning(solver):
+    n, T = 60, 300
+    C = correlation(n, T, 0)
+    packed, diag = ff.rmt_filter(C, T/n, solver=solver, block_size=16)
+    C_RMT = baseline_rmt(C, T/n)
+    np.testing.assert_allclose(packed, storage.pack_triu(C_RMT), atol=1e-10)
+    np.testing.assert_allclose(diag, np.diag(C_RMT), atol=1e-10)
+
+@pytest.mark.parametrize("p", ff.P_LIST)
+def test_naive_cuts_match_baseline(p):
+    n = 40
+    C = correlation(n, 200, 1, decimals=2)
+    packed, diag = storage.pack_triu(C), np.diag(C)
+    order, cuts = ff.naive_cuts(packed, diag, [p])
+    selected = np.zeros(len(packed) + n, dtype=bool)
+    selected[order[:cuts[0]]] = True
+
+    # Original filter: keep the entries among the lowest p fraction of the distinct values
+    flat = np.unique(C.flatten())
+    kept = np.isin(C, flat[:int(p*len(flat))])
+    np.testing.assert_array_equal(selected[:len(packed)], storage.pack_triu(kept))
+    np.testing.assert_array_equal(selected[len(packed):], np.diag(kept))
+
+def test_sweeps_match_dense_filters():
+    n, T = 50, 400
+    C = correlation(n, T, 2)
+    packed = storage.pack_triu(C)
+    fisher = ff.fisher_sweep(packed, T, ff.TAU_LIST)
+    naive = ff.naive_sweep(packed, np.diag(C), ff.P_LIST)
+    off = 1 - np.eye(n)
+    for j, tau in enumerate(ff.TAU_LIST):
+        C_tau = np.tanh(tau/np.sqrt(T - 3))
+        expected = np.where(C >= C_tau, C, 0)*off
+        np.testing.assert_array_equal(ff.threshold_matrix(n, fisher, j).toarray(), expected)
+    for j, p in enumerate(ff.P_LIST):
+        flat = np.unique(C.flatten())
+        expected = np.where(np.isin(C, flat[:int(p*len(flat))]), C, 0)*off
+        np.testing.assert_array_equal(ff.threshold_matrix(n, naive, j).toarray(), expected)
+
+def test_sweep_file_round_trip(tmp_path):
+    C = correlation(30, 200, 3)
+    packed = storage.pack_triu(C)
+    sweep = {"Fisher": ff.fisher_sweep(packed, 200, ff.TAU_LIST)}
+    path = str(tmp_path/"sweep.npz")
+    ff.save_sweep(path, 30, sweep, {"Fisher": ff.TAU_LIST})
+    n, loaded = ff.load_sweep(path)
+    assert n == 30 and list(loaded) == ["Fisher"]
+    for key, value in sweep["Fisher"].items():
+        np.testing.assert_array_equal(loaded["Fisher"][key], value)
+    np.testing.assert_array_equal(loaded["Fisher"]["thresholds"], ff.TAU_LIST)
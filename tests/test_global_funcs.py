@@ -0,0 +1,76 @@
+import numpy as np
+import networkx as nx
+import pytest
+
+gt = pytest.importorskip("graph_tool.all")
+import global_funcs as gf
+
+def reference_knn_exponent(g):
+    # Per-degree loop of the original knn_scaling_exponent, on the dense adjacency
+    nodes = g.get_vertices()
+    degree_list = g.get_out_degrees(nodes)
+    A = gt.adjacency(g).todense()
+    knns_vals = np.asarray(A @ degree_list.reshape(-1, 1)).ravel()
+    knns_vals = np.divide(knns_vals, degree_list, out=np.zeros(len(nodes)), where=degree_list != 0)
+    avg_knns = []
+    for k in range(1, int(np.max(degree_list)) + 1):
+        arr = knns_vals[degree_list == k]
+        avg_knns.append(np.sum(arr)/len(arr) if len(arr) else 0)
+    avg_knns = np.array(avg_knns)
+    x = np.log(np.arange(1, len(avg_knns) + 1)[avg_knns > 0])
+    y = np.log(avg_knns[avg_knns > 0])
+    return knns_vals, gf.linregress(x, y)
+
+@pytest.mark.parametrize("seed", [0, 1])
+def test_knn_matches_dense_reference(seed):
+    rng = np.random.default_rng(seed)
+    n = 300
+    rows, cols = np.triu_indices(n, 1)
+    keep = rng.random(len(rows)) < .05
+    g = gf.edges2graph(n, rows[keep], cols[keep])
+
+    knns_ref, fit = reference_knn_exponent(g)
+    knns = gf.average_neighbor_degree(g)
+    np.testing.assert_allclose(np.array(list(knns.values())), knns_ref, rtol=1e-12)
+    slope, err = gf.knn_scaling_exponent(g, knns)
+    np.testing.assert_allclose((slope, err), (fit.slope, fit.stderr), rtol=1e-10)
+
+def test_knn_exponent_accepts_uint64_degrees():
+    degrees = np.array([1, 2, 2, 3, 3, 3], dtype=np.uint64)
+    knns = np.array([3., 2.5, 2.5, 2., 2., 2.])
+    slope, _ = gf.knn_exponent(degrees, knns)
+    assert slope < 0
+
+def random_graph(n, p, seed):
+    rng = np.random.default_rng(seed)
+    rows, cols = np.triu_indices(n, 1)
+    keep = rng.random(len(rows)) < p
+    G = nx.Graph()
+    G.add_nodes_from(range(n))
+    G.add_edges_from(zip(rows[keep].tolist(), cols[keep].tolist()))
+    return gf.edges2graph(n, rows[keep], cols[keep]), G
+
+@pytest.mark.parametrize("n_threads", [1, 3])
+def test_path_length_matches_all_pairs(n_threads):
+    g, G = random_graph(120, .05, 2)
+    assert nx.is_connected(G)
+    lengths = dict(nx.all_pairs_shortest_path_length(G))
+    sums = [sum(lengths[v].values()) for v in range(120)]
+    np.testing.assert_array_equal(gf.distance_sums(g, range(120), n_threads), sums)
+    assert gf.avg_shortest_path(g, n_threads) == pytest.approx(nx.average_shortest_path_length(G), rel=1e-12)
+
+def test_sampled_path_length():
+    g, G = random_graph(120, .05, 2)
+    exact = nx.average_shortest_path_length(G)
+    # All the vertices as pivots give the exact value, a seed gives the same pivots
+    assert gf.sampled_shortest_path(g, 120, seed=0) == (pytest.approx(exact, rel=1e-12), 0.)
+    L, err = gf.sampled_shortest_path(g, 30, seed=1234)
+    assert (L, err) == gf.sampled_shortest_path(g, 30, seed=1234, n_threads=2)
+    assert abs(L - exact) < 5*err
+    assert gf.compute_global_variables(g, measures=['Avg_path_length'], n_pivots=30, seed=1234) == \
+           {'Avg_path_length': L, 'Avg_path_length_err': err}
+
+def test_path_length_of_disconnected_graph():
+    g = gf.edges2graph(4, np.array([0, 2]), np.array([1, 3]))
+    assert np.isnan(gf.avg_shortest_path(g))
+    assert np.isnan(gf.sampled_shortest_path(g, 2, seed=0)).all()
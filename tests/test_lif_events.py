@@ -0,0 +1,93 @@
+import numpy as np
+from scipy.integrate import quad, solve_ivp
+from scipy.sparse import csr_matrix
+from scipy.special import erfcx
+
+from conftest import load_script
+
+lif = load_script('LIF/ts_generator.py')
+
+def test_scaled_upper_gamma():
+    # exp(z)*z**(-a)*Gamma(a, z) on both sides of GAMMA_SPLIT, for an array and a scalar argument: in
+    # closed form for a = -1/2, else from int_0^inf (1 + x/z)**(a - 1) exp(-x) dx / z
+    z = np.r_[1e-3, 0.5, 1.9, 2., 2.1, 7.3, 41., 1e3]
+    references = {-0.5: 2 - 2*np.sqrt(np.pi*z)*erfcx(np.sqrt(z))}
+    for a in (-0.3, -1.7):
+        references[a] = [quad(lambda x: (1 + x/z_i)**(a - 1)*np.exp(-x), 0, np.inf, epsrel=1e-13)[0]/z_i
+                         for z_i in z[1:]]
+    for a, expected in references.items():
+        z_a = z[-len(expected):]
+        np.testing.assert_allclose(lif.scaled_upper_gamma(a, z_a), expected, rtol=1e-11)
+        gamma = lif.scalar_gamma(a)
+        np.testing.assert_allclose([gamma(z_i) for z_i in z_a], expected, rtol=1e-11)
+
+def test_propagation_matches_integration():
+    u0, g0, s = np.array([-20., 10., 55.]), np.array([0., 0.3, 2.]), np.array([0.7, 3., 12.])
+    u, g, G = lif.LIF_propagate(u0, g0, s)
+    np.testing.assert_allclose(g, g0*np.exp(-s/5))
+    np.testing.assert_allclose(G, lif.scaled_upper_gamma(-0.5, g*5))
+    for j in range(3):
+        sol = solve_ivp(lambda t, x: (0 - x + 50*10)/10 - g0[j]*np.exp(-t/5)*(x - 65), (0, s[j]),
+                        [u0[j]], rtol=1e-11, atol=1e-11)
+        np.testing.assert_allclose(u[j], sol.y[0, -1], rtol=1e-8)
+
+def test_uncoupled_neurons_fire_periodically():
+    # Without coupling every neuron crosses at tau*log((u_inf - u)/(u_inf - theta)) and then
+    # with period tau*log((u_inf - u_r)/(u_inf - theta))
+    u0 = np.array([-20., 0., 30.])
+    _, _, times, neurons = lif.LIF_events(u0, 10, 0., csr_matrix((3, 3)), dt=0.01)
+    u_inf, theta, u_r, tau = 500, 60, -5, 10
+    period = tau*np.log((u_inf - u_r)/(u_inf - theta))
+    for j in range(3):
+        t_j = times[neurons == j]
+        first = tau*np.log((u_inf - u0[j])/(u_inf - theta))
+        np.testing.assert_allclose(t_j, first + period*np.arange(len(t_j)), atol=1e-8)
+
+def test_cost_scales_with_spikes(monkeypatch):
+    # The number of exact crossing solves depends on the spikes, not on the sampling grid
+    rng = np.random.default_rng(0)
+    n = 60
+    A = (rng.random((n, n)) < .1).astype(float)
+    A = csr_matrix(np.triu(A, 1) + np.triu(A, 1).T)
+    u0 = -20 + rng.random(n)*40
+
+    calls = []
+    crossing_time = lif.crossing_time
+    def counted(*args, **kwargs):
+        calls.append(args)
+        return crossing_time(*args, **kwargs)
+    monkeypatch.setattr(lif, 'crossing_time', counted)
+
+    # Two sampling grids, ten times apart, ending at the same time
+    runs = []
+    for T, dt in ((3.01, 0.05), (3.001, 0.005)):
+        calls.clear()
+        t_values, u_values, times, neurons = lif.LIF_events(u0, T, .4, A, dt=dt)
+        assert np.isclose(t_values[-1], 3.)
+        runs.append((len(calls), times, neurons, u_values))
+    (solves_coarse, times_coarse, neurons_coarse, _), (solves_fine, times, neurons, u_fine) = runs
+
+    assert len(times) > n
+    assert solves_coarse == solves_fine
+    assert solves_fine <= 2*len(times)
+    np.testing.assert_array_equal(neurons_coarse, neurons)
+    np.testing.assert_allclose(times_coarse, times, atol=1e-9)
+    assert np.all(u_fine < 60 + 1e-6)
+
+def test_spike_matrix_keeps_first_spike_per_sample():
+    neurons = np.array([1, 0, 1, 1])
+    rows = np.array([2, 2, 2, 4])
+    times = np.array([0.025, 0.021, 0.022, 0.041])
+    spikes = lif.spike_matrix(neurons, rows, times, (2, 5)).toarray()
+    expected = np.zeros((2, 5))
+    expected[0, 2], expected[1, 2], expected[1, 4] = 0.021, 0.022, 0.041
+    np.testing.assert_array_equal(spikes, expected)
+
+def test_spike_train_detects_local_maxima():
+    t = np.arange(8)*0.1
+    x = np.array([[0, 0], [1, 0], [0, 2], [0, 1], [3, 0], [1, 0], [0, 0], [0, 5]], dtype=float)
+    spikes = lif.spike_train(t, x)
+    assert spikes.shape == (2, 8)
+    np.testing.assert_array_equal(spikes[0].indices, [1, 4])
+    np.testing.assert_allclose(spikes[0].data, t[[1, 4]])
+    np.testing.assert_array_equal(spikes[1].indices, [2])
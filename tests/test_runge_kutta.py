@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+import runge_kutta as rk
+
+def decay(x, t, lam, out=None):
+    # dx/dt = -lam*x (lam broadcasts against a stacked state)
+    if out is None:
+        return -lam*x
+    np.multiply(x, -lam, out=out)
+    return out
+
+def test_sampling_grid_burn_in_and_decimation():
+    t_values, idx = rk.sampling_grid(1., .1, record_every=3, burn_in=.2)
+    np.testing.assert_allclose(t_values, np.arange(0, 1., .1))
+    np.testing.assert_array_equal(idx, [2, 5, 8])
+
+def test_rk4_is_fourth_order():
+    errors = []
+    for dt in (.1, .05):
+        t, x = rk.runge_kutta(decay, np.array([1.]), 2., dt=dt, lam=1.)
+        errors.append(np.max(np.abs(x[:, 0] - np.exp(-t))))
+    assert errors[0]/errors[1] == pytest.approx(16, rel=.1)
+
+def test_inplace_and_blocks_match_runge_kutta():
+    lam = np.array([[.5], [2.]])
+    x0 = np.array([[1., 2.], [3., 4.]])
+    t, x = rk.runge_kutta(decay, x0, 1., dt=.01, record_every=7, burn_in=.1, lam=lam)
+    t_in, x_in = rk.runge_kutta(decay, x0, 1., dt=.01, inplace=True, record_every=7, burn_in=.1, lam=lam)
+    blocks = list(rk.runge_kutta_blocks(decay, x0, 1., dt=.01, block_size=4, record_every=7, burn_in=.1, lam=lam))
+    np.testing.assert_allclose(x_in, x, rtol=1e-14)
+    np.testing.assert_array_equal(np.concatenate([b[0] for b in blocks]), t)
+    np.testing.assert_allclose(np.concatenate([b[1] for b in blocks]), x, rtol=1e-14)
+    assert x.shape == (len(t), 2, 2)
+
+def test_dormand_prince_dense_output():
+    x0 = np.array([1., -1.])
+    t, x, stats = rk.dormand_prince(decay, x0, 5., dt=.01, rtol=1e-8, atol=1e-10, record_every=10, burn_in=.5, lam=1.3)
+    t_rk, _ = rk.runge_kutta(decay, x0, 5., dt=.01, record_every=10, burn_in=.5, lam=1.3)
+    np.testing.assert_array_equal(t, t_rk)
+    np.testing.assert_allclose(x, x0*np.exp(-1.3*t[:, np.newaxis]), rtol=1e-6, atol=1e-9)
+    assert stats['n_steps'] < len(np.arange(0, 5., .01))
+    assert stats['n_fevals'] == 1 + 6*(stats['n_steps'] + stats['n_rejected'])
@@ -0,0 +1,115 @@
+import os
+import gzip
+import numpy as np
+import pytest
+
+import storage
+
+@pytest.mark.parametrize("compression", [None, "zlib"])
+def test_array_round_trip(tmp_path, compression):
+    x = np.random.default_rng(0).standard_normal((25, 4))
+    path = str(tmp_path/("x" + storage.EXT))
+    with storage.ArrayWriter(path, compression=compression, T=25, model="test") as writer:
+        writer.append(x[:10])
+        writer.append(x[10:])
+    header = storage.load_header(path)
+    assert header["shape"] == [25, 4] and header["T"] == 25 and header["model"] == "test"
+    y = storage.load_array(path)
+    np.testing.assert_array_equal(y, x)
+    assert isinstance(y, np.memmap) == (compression is None)
+
+def test_write_blocks_splits_batched_state(tmp_path):
+    x = np.random.default_rng(1).standard_normal((12, 2, 3))
+    blocks = ((None, x[i:i + 5]) for i in range(0, 12, 5))
+    paths = [str(tmp_path/f"{j}{storage.EXT}") for j in range(2)]
+    assert storage.write_blocks(blocks, paths, meta=[{"K": 0.}, {"K": 1.}]) == 12
+    for j, path in enumerate(paths):
+        np.testing.assert_array_equal(storage.load_array(path), x[:, j])
+        assert storage.load_header(path)["K"] == j
+
+def test_triu_round_trip(tmp_path):
+    n = 7
+    a = np.random.default_rng(2).standard_normal((n, n))
+    C = np.triu(a, 1) + np.triu(a, 1).T + np.eye(n)
+    packed = storage.pack_triu(C)
+    assert len(packed) == n*(n - 1)//2 and storage.triu_n(len(packed)) == n
+    np.testing.assert_array_equal(storage.unpack_triu(packed), C)
+    with pytest.raises(ValueError):
+        storage.triu_n(len(packed) + 1)
+
+    path, dense = str(tmp_path/("c" + storage.EXT)), str(tmp_path/("d" + storage.EXT))
+    storage.save_triu(path, C, T=100)
+    storage.save_array(dense, C)
+    np.testing.assert_array_equal(storage.load_triu(path), packed)
+    np.testing.assert_array_equal(storage.load_triu(dense), packed)
+    np.testing.assert_array_equal(storage.load_matrix(path), storage.unpack_triu(packed))
+    assert storage.load_header(path)["packed"] == "triu"
+
+def write_csv(path, x):
+    with gzip.open(path, "wt") as f:
+        np.savetxt(f, x, delimiter=",")
+
+def test_convert_csv_archives(tmp_path):
+    rng = np.random.default_rng(3)
+    folder = tmp_path/"time_series"/"LIF"/"spike_trains"/"K_1.5"
+    folder.mkdir(parents=True)
+    series, spikes = str(tmp_path/"LIF_10_2.csv.gz"), str(folder/"LIF_10_2.csv.gz")
+    x, s = rng.standard_normal((30, 10)), (rng.random((30, 10)) < .2).astype(float)
+    write_csv(series, x)
+    write_csv(spikes, s)
+    assert storage.csv_kind(series) == "series" and storage.csv_kind(spikes) == "spikes"
+    assert storage.csv_kind("/mnt/corr_matrices/LIF/spike_trains/K_1.5/LIF_10_2.csv.gz") == "matrix"
+
+    # Time series record their number of rows as T
+    path = storage.convert_csv(series, series=True, **storage.csv_meta(series))
+    np.testing.assert_array_equal(storage.load_array(path), x)
+    assert storage.load_header(path)["T"] == 30
+
+    # Spike trains become sparse (n, T) matrices carrying the run metadata
+    path = storage.convert_spikes(spikes, **storage.csv_meta(spikes))
+    S, meta = storage.load_spikes(path)
+    np.testing.assert_array_equal(S.toarray(), s.T)
+    assert meta == {"model": "LIF", "n": 10, "i": 2, "K": 1.5, "T": 30}
+
+def test_spikes_round_trip(tmp_path):
+    from scipy.sparse import csr_matrix, load_npz
+    S = csr_matrix(np.array([[0, .5, 0], [1.2, 0, 2.7]]))
+    path = str(tmp_path/"s.npz")
+    storage.save_spikes(path, S, model="LIF", K=np.float64(1.), seed=1234)
+    loaded, meta = storage.load_spikes(path)
+    np.testing.assert_array_equal(loaded.toarray(), S.toarray())
+    assert meta == {"model": "LIF", "K": 1., "seed": 1234}
+    np.testing.assert_array_equal(load_npz(path).toarray(), S.toarray())
+
+ROWS = [("kuramoto", 1.0, 100, 1, "Fisher", 1.5, "Mean_degree", 3., np.nan),
+        ("kuramoto", 1.0, 100, 1, "Fisher", 1.5, "Global_clustering", .2, .01),
+        ("kuramoto", 2.5, 200, 2, "Naive", .1, "Mean_degree", 5., np.nan),
+        ("kuramoto", np.nan, 100, 1, "original", np.nan, "Mean_degree", 4., np.nan)]
+
+def test_results_table_filters(tmp_path):
+    table = str(tmp_path/"table")
+    with storage.ResultsWriter(table, mode="w") as writer:
+        writer.append(ROWS[:2])
+        writer.append(ROWS[2:])
+
+    r = storage.load_results(table, columns=["K", "value"], measure="Mean_degree")
+    np.testing.assert_array_equal(r["value"], [3., 5., 4.])
+    r = storage.load_results(table, columns=["method"], K=np.nan)
+    np.testing.assert_array_equal(r["method"], ["original"])
+    r = storage.load_results(table, columns=["value"], K=[1.0, np.nan], measure="Mean_degree")
+    np.testing.assert_array_equal(r["value"], [3., 4.])
+    r = storage.load_results(table, columns=["measure"], rows=slice(1, 3))
+    np.testing.assert_array_equal(r["measure"], ["Global_clustering", "Mean_degree"])
+    assert len(storage.load_results(table, measure="unknown")["value"]) == 0
+
+def test_results_table_drops_interrupted_append(tmp_path):
+    table = str(tmp_path/"table")
+    with storage.ResultsWriter(table, mode="w") as writer:
+        writer.append(ROWS[:1])
+    with open(os.path.join(table, "value.col"), "ab") as f:
+        f.write(b"partial")
+    with storage.ResultsWriter(table) as writer:
+        writer.append(ROWS[1:2])
+    r = storage.load_results(table)
+    np.testing.assert_array_equal(r["value"], [3., .2])
+    np.testing.assert_array_equal(r["error"], [np.nan, .01])
@@ -0,0 +1,82 @@
+import numpy as np
+import networkx as nx
+import pytest
+
+import sweep_funcs as sf
+
+def random_edges(n, p, seed):
+    rng = np.random.default_rng(seed)
+    rows, cols = np.triu_indices(n, 1)
+    order = rng.permutation(len(rows))[:int(p*len(rows))]
+    return rows[order], cols[order]
+
+def reference_assortativity(n, rows, cols):
+    # Categorical degree assortativity and jackknife error, from scratch over the edge list
+    k = np.bincount(np.r_[rows, cols], minlength=n)
+    k1, k2 = k[np.r_[rows, cols]], k[np.r_[cols, rows]]
+    m2 = float(len(k1))
+    a = np.bincount(k, weights=k)
+    t1 = np.sum(k1 == k2)/m2
+    t2 = np.sum(a**2)/m2**2
+    r = (t1 - t2)/(1 - t2)
+    t2_l = (t2*m2**2 - a[k1] - a[k2])/(m2 - 1)**2
+    t1_l = (t1*m2 - (k1 == k2))/(m2 - 1)
+    r_l = (t1_l - t2_l)/(1 - t2_l)
+    return r, np.sqrt(np.sum((r - r_l)**2))
+
+@pytest.mark.parametrize("seed", [0, 1])
+def test_incremental_graph_matches_recomputation(seed):
+    n = 120
+    rows, cols = random_edges(n, .08, seed)
+    graph = sf.IncrementalGraph(n)
+    done = 0
+    for cut in (10, 60, 300, len(rows)):
+        graph.add_edges(rows[done:cut], cols[done:cut])
+        done = cut
+
+        G = nx.Graph()
+        G.add_nodes_from(range(n))
+        G.add_edges_from(zip(rows[:cut].tolist(), cols[:cut].tolist()))
+        values = graph.measures()
+        degrees = np.array([d for _, d in sorted(G.degree())])
+        components = [len(c) for c in nx.connected_components(G)]
+
+        assert values['Mean_degree'] == pytest.approx(np.mean(degrees))
+        assert values['MR_coefficient'] == pytest.approx(np.mean(degrees**2)/np.mean(degrees))
+        assert values['Global_clustering'][0] == pytest.approx(nx.transitivity(G))
+        np.testing.assert_allclose(values['Assortativity'], reference_assortativity(n, rows[:cut], cols[:cut]),
+                                   rtol=1e-9, atol=1e-12)
+        assert values['N_components'] == len(components)
+        assert values['Giant_component'] == max(components)
+
+def test_assortativity_without_degree_variance():
+    # graph_tool returns nan in these cases, and so must the incremental path
+    assert np.isnan(sf.IncrementalGraph(5).assortativity()).all()
+    ring = sf.IncrementalGraph(6)
+    ring.add_edges(np.arange(6), (np.arange(6) + 1) % 6)
+    assert np.isnan(ring.assortativity()).all()
+    matching = sf.IncrementalGraph(6)
+    matching.add_edges([0, 2, 4], [1, 3, 5])
+    assert np.isnan(matching.assortativity()).all()
+
+def test_sweep_measures_follow_threshold_order():
+    n = 50
+    rows, cols = random_edges(n, .2, 2)
+    cuts = np.array([len(rows), 40, 120])
+    results = sf.sweep_measures(n, {"rows": rows, "cols": cols, "cuts": cuts})
+    for cut, values in zip(cuts, results):
+        assert values['Mean_degree'] == pytest.approx(2*cut/n)
+
+def test_percolation_matches_components():
+    n = 80
+    rows, cols = random_edges(n, .05, 2)
+    curve = sf.percolation_curve(n, rows, cols)
+    steps = np.arange(len(rows) + 1)
+    giant, n_comp, chi = sf.percolation_at(curve, steps)
+    G = nx.empty_graph(n)
+    for e in steps:
+        if e:
+            G.add_edge(rows[e - 1], cols[e - 1])
+        sizes = sorted((len(c) for c in nx.connected_components(G)), reverse=True)
+        assert giant[e] == sizes[0] and n_comp[e] == len(sizes)
+        assert np.isclose(chi[e], sum(s**2 for s in sizes[1:])/n)
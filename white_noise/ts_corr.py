@@ -2,8 +2,10 @@
 
 import os
 import sys
-import gzip
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
 import numpy as np
+import storage
 import multiprocessing
 from multiprocessing import Manager
 np.random.seed(1234)
@@ -27,15 +29,16 @@ def ts_corr(params, counter, lock, L):
      # Extract input/output folder paths
     input_, output_ = params
 
-    with gzip.open(input_, "rt") as f:
-        x_vals_loaded = np.loadtxt(f, delimiter=",")
+    x_vals_loaded = storage.load_array(input_)
 
     standized_vals = standardize_matrix(x_vals_loaded)
     correlation_matrix = np.corrcoef(standized_vals, rowvar=False)
 
     # Save the results
-    with gzip.open(output_, "wt") as f:
-            np.savetxt(f, correlation_matrix, delimiter=",")
+    meta = storage.load_header(input_)
+    for key in ("shape", "dtype", "compression"):
+        meta.pop(key)
+    storage.save_triu(output_, correlation_matrix, **meta)
 
 def main():
      
@@ -48,7 +51,7 @@ def main():
     # Iterate through each file in the input folder
     params = []
     for file_name in os.listdir(input_folder):
-        if file_name.endswith(".csv.gz"):
+        if file_name.endswith(storage.EXT):
             input_file_path = os.path.join(input_folder, file_name)
             output_file_path = os.path.join(output_folder, file_name)
             params.append([input_file_path, output_file_path])
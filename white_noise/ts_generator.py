@@ -2,12 +2,15 @@
 
 import os
 import sys
-import gzip
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
 import numpy as np
+import storage
 import multiprocessing
 from multiprocessing import Manager
 
-np.random.seed(1234)
+SEED = 1234
+np.random.seed(SEED)
 
 def ts_generator(params, counter, lock, L):
     with lock:  # Use explicit lock for thread safety
@@ -15,15 +18,14 @@ def ts_generator(params, counter, lock, L):
         print(f"Computing... {counter.value}/{L}", end="\r")
     
     # Extract input/output folder paths
-    output_, n = params
+    output_, n, i = params
 
     # Compute time series
     T, dt = 10, 0.005
     x_vals = np.random.normal(size=(int(T/dt), n))
 
     # Save the results
-    with gzip.open(output_, "wt") as f:
-        np.savetxt(f, x_vals, delimiter=",")
+    storage.save_array(output_, x_vals, model="white", n=n, i=i, T=len(x_vals), dt=dt, seed=SEED)
 
 def main():
     input_folder = "./graphs"
@@ -42,8 +44,8 @@ def main():
             n = int(n_str)
             i = int(i_str)
 
-            output_file_path = os.path.join(output_folder, f"white_{n}_{i}.csv.gz")
-            params.append([output_file_path, n])
+            output_file_path = os.path.join(output_folder, f"white_{n}_{i}{storage.EXT}")
+            params.append([output_file_path, n, i])
     L = len(params)
 
     # Create a shared counter and lock using Manager